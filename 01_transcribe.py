@@ -2,11 +2,25 @@ try:
     import time
     import os
     import json
+    import gzip
     import sys
+    import shutil
+    import hashlib
+    import random
+    import threading
+    from array import array
+    from collections import deque
+    from datetime import datetime, timedelta, timezone
     from pathlib import Path
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
     import boto3
+    import ijson
+    import numpy as np
     import pandas as pd
-    from botocore.exceptions import NoCredentialsError
+    from boto3.s3.transfer import TransferConfig
+    from s3transfer.utils import ReadFileChunk
+    from botocore.config import Config
+    from botocore.exceptions import ClientError, NoCredentialsError
     from dotenv import load_dotenv
 except ModuleNotFoundError as e:
     print(f"Erro: {e}")
@@ -32,6 +46,44 @@ S3_OUTPUT_PREFIX = os.getenv('TRANSCRIBE_S3_OUTPUT_PREFIX')
 MEDIA_FORMAT = os.getenv('TRANSCRIBE_MEDIA_FORMAT')
 LANGUAGE_CODE = os.getenv('TRANSCRIBE_LANGUAGE_CODE')
 
+# Uploads concorrentes (arquivos em paralelo) e configuração de multipart
+UPLOAD_WORKERS = int(os.getenv('TRANSCRIBE_UPLOAD_WORKERS', 4))
+UPLOAD_MAX_CONCURRENCY = int(os.getenv('TRANSCRIBE_UPLOAD_MAX_CONCURRENCY', 8))
+MULTIPART_THRESHOLD_MB = int(os.getenv('TRANSCRIBE_MULTIPART_THRESHOLD_MB', 64))
+MULTIPART_CHUNKSIZE_MB = int(os.getenv('TRANSCRIBE_MULTIPART_CHUNKSIZE_MB', 64))
+
+# Upload multipart retomável com checkpoint em disco (partes concluídas e UploadId)
+RESUMABLE_UPLOAD = os.getenv('TRANSCRIBE_RESUMABLE_UPLOAD', 'False').lower() == 'true'
+CHECKPOINT_FOLDER = os.getenv('TRANSCRIBE_UPLOAD_CHECKPOINT_FOLDER', os.path.join(LOCAL_OUTPUT_FOLDER or 'output', 'upload_checkpoints'))
+STALE_UPLOAD_HOURS = float(os.getenv('TRANSCRIBE_STALE_UPLOAD_HOURS', 24))
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Cache local de transcrições (chave: SHA-256 da mídia + idioma + formato)
+CACHE_FILE = os.getenv('TRANSCRIBE_CACHE_FILE', os.path.join(LOCAL_OUTPUT_FOLDER or 'output', 'transcribe_cache.json'))
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Consulta de status em lote com intervalo adaptativo
+JOB_NAME_PREFIX = 'transcribe-'
+POLL_MIN_SECONDS = float(os.getenv('TRANSCRIBE_POLL_MIN_SECONDS', 5))
+POLL_MAX_SECONDS = float(os.getenv('TRANSCRIBE_POLL_MAX_SECONDS', 120))
+
+# Controle de admissão: máximo de jobs simultâneos (vazio/0 = descobrir pela cota da conta)
+MAX_CONCURRENT_JOBS = int(os.getenv('TRANSCRIBE_MAX_CONCURRENT_JOBS') or 0)
+DEFAULT_CONCURRENT_JOBS = 100
+START_RETRY_BASE_SECONDS = 2
+START_RETRY_MAX_SECONDS = 60
+
+# Extração da transcrição por streaming (sem baixar o JSON completo para o disco)
+STREAM_RESULTS = os.getenv('TRANSCRIBE_STREAM_RESULTS', 'False').lower() == 'true'
+KEEP_JSON = os.getenv('TRANSCRIBE_KEEP_JSON', 'True').lower() == 'true'
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Tempos por palavra em formato colunar (NumPy + blob de tokens), carregável via memory-map
+WORD_TIMINGS = os.getenv('TRANSCRIBE_WORD_TIMINGS', 'False').lower() == 'true'
+
+# Fila persistente para retomar uma execução interrompida sem duplicar jobs
+QUEUE_FILE = os.getenv('TRANSCRIBE_QUEUE_FILE', os.path.join(LOCAL_OUTPUT_FOLDER or 'output', 'transcribe_queue.json'))
+
 def check_aws_credentials():
     """Verifica se há credenciais AWS válidas"""
     try:
@@ -61,116 +113,713 @@ if not os.path.exists(INPUT_CSV):
 
 # Criar pasta de output
 os.makedirs(LOCAL_OUTPUT_FOLDER, exist_ok=True)
+if RESUMABLE_UPLOAD:
+    os.makedirs(CHECKPOINT_FOLDER, exist_ok=True)
 
-# Inicializar clientes AWS
-s3_client = boto3.client('s3')
+# Configuração de transferência (multipart) usada em cada upload
+transfer_config = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD_MB * 1024 * 1024,
+    multipart_chunksize=MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+    max_concurrency=UPLOAD_MAX_CONCURRENCY,
+    use_threads=True
+)
+
+# Inicializar clientes AWS (pool de conexões suficiente para todos os uploads simultâneos)
+s3_client = boto3.client(
+    's3',
+    config=Config(max_pool_connections=max(10, UPLOAD_WORKERS * UPLOAD_MAX_CONCURRENCY))
+)
 transcribe_client = boto3.client('transcribe')
 
+def checkpoint_path_for(file_name):
+    """Caminho do checkpoint de upload de um arquivo"""
+    return os.path.join(CHECKPOINT_FOLDER, f"{file_name}.json")
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """Salva o checkpoint de forma atômica (arquivo temporário + rename)"""
+    temp_file = checkpoint_path + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(temp_file, checkpoint_path)
+
+def load_checkpoint(client, checkpoint_path, bucket, key, stat, part_size):
+    """Carrega um checkpoint válido para o mesmo arquivo/destino, conferindo as partes no S3"""
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path, 'r', encoding='utf-8') as f:
+        checkpoint = json.load(f)
+    
+    # Arquivo alterado ou destino diferente: o upload anterior não serve mais
+    same_source = (checkpoint['bucket'] == bucket and checkpoint['key'] == key
+                   and checkpoint['size'] == stat.st_size and checkpoint['mtime_ns'] == stat.st_mtime_ns
+                   and checkpoint['part_size'] == part_size)
+    if not same_source:
+        return None
+    
+    # As partes confirmadas pelo S3 prevalecem sobre o checkpoint local
+    parts = {}
+    params = {'Bucket': bucket, 'Key': key, 'UploadId': checkpoint['upload_id']}
+    try:
+        while True:
+            page = client.list_parts(**params)
+            for part in page.get('Parts', []):
+                parts[str(part['PartNumber'])] = part['ETag']
+            if not page.get('IsTruncated'):
+                break
+            params['PartNumberMarker'] = page['NextPartNumberMarker']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'NoSuchUpload':
+            return None
+        raise
+    checkpoint['parts'] = parts
+    return checkpoint
+
+def resumable_upload(client, file_path, bucket, key, part_size, checkpoint_path, max_workers=4):
+    """Upload multipart que continua da última parte concluída se o processo for interrompido"""
+    stat = os.stat(file_path)
+    part_size = max(part_size, MIN_PART_SIZE)
+    total_parts = max(1, -(-stat.st_size // part_size))
+    
+    checkpoint = load_checkpoint(client, checkpoint_path, bucket, key, stat, part_size)
+    if checkpoint:
+        print(f"Retomando upload de {os.path.basename(file_path)}: {len(checkpoint['parts'])}/{total_parts} partes já enviadas")
+    else:
+        upload = client.create_multipart_upload(Bucket=bucket, Key=key)
+        checkpoint = {
+            'bucket': bucket,
+            'key': key,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'part_size': part_size,
+            'upload_id': upload['UploadId'],
+            'parts': {}
+        }
+    save_checkpoint(checkpoint_path, checkpoint)
+    checkpoint_lock = threading.Lock()
+    
+    def upload_part(part_number):
+        # Parte lida do disco sob demanda (trecho do arquivo), sem carregar part_size bytes na memória
+        with ReadFileChunk.from_filename(file_path, (part_number - 1) * part_size, part_size,
+                                         enable_callbacks=False) as body:
+            response = client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=checkpoint['upload_id'],
+                PartNumber=part_number,
+                Body=body
+            )
+        # Registrar a parte concluída antes de seguir para a próxima
+        with checkpoint_lock:
+            checkpoint['parts'][str(part_number)] = response['ETag']
+            save_checkpoint(checkpoint_path, checkpoint)
+    
+    missing_parts = [n for n in range(1, total_parts + 1) if str(n) not in checkpoint['parts']]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [executor.submit(upload_part, n) for n in missing_parts]:
+            future.result()
+    
+    client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=checkpoint['upload_id'],
+        MultipartUpload={'Parts': [
+            {'PartNumber': n, 'ETag': checkpoint['parts'][str(n)]} for n in range(1, total_parts + 1)
+        ]}
+    )
+    os.remove(checkpoint_path)
+
+def abort_stale_uploads(client, bucket, prefix, max_age_hours):
+    """Aborta uploads multipart antigos sem checkpoint local (evita cobrança por partes órfãs)"""
+    active_ids = set()
+    if os.path.isdir(CHECKPOINT_FOLDER):
+        for name in os.listdir(CHECKPOINT_FOLDER):
+            if name.endswith('.json'):
+                with open(os.path.join(CHECKPOINT_FOLDER, name), 'r', encoding='utf-8') as f:
+                    active_ids.add(json.load(f)['upload_id'])
+    
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=max_age_hours)
+    aborted = 0
+    params = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        page = client.list_multipart_uploads(**params)
+        for upload in page.get('Uploads', []):
+            if upload['UploadId'] in active_ids or upload['Initiated'] > cutoff:
+                continue
+            client.abort_multipart_upload(Bucket=bucket, Key=upload['Key'], UploadId=upload['UploadId'])
+            aborted += 1
+        if not page.get('IsTruncated'):
+            break
+        params['KeyMarker'] = page['NextKeyMarker']
+        params['UploadIdMarker'] = page['NextUploadIdMarker']
+    return aborted
+
+def load_cache():
+    """Carrega o cache de transcrições (hashes memorizados e transcrições já feitas)"""
+    if os.path.exists(CACHE_FILE):
+        try:
+            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            data.setdefault('hashes', {})
+            data.setdefault('transcriptions', {})
+            return data
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"[AVISO] Cache {CACHE_FILE} inválido, ignorando: {e}")
+    return {'hashes': {}, 'transcriptions': {}}
+
+def save_cache():
+    """Salva o cache de forma atômica (arquivo temporário + rename)"""
+    with cache_lock:
+        temp_file = CACHE_FILE + ".tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, CACHE_FILE)
+
+def file_sha256(file_path):
+    """Calcula o SHA-256 do arquivo em blocos, reaproveitando o hash se (caminho, tamanho, mtime) não mudou"""
+    abs_path = os.path.abspath(file_path)
+    stat = os.stat(abs_path)
+    
+    with cache_lock:
+        memo = cache['hashes'].get(abs_path)
+    if memo and memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+        return memo['sha256']
+    
+    digest = hashlib.sha256()
+    with open(abs_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(block)
+    
+    with cache_lock:
+        cache['hashes'][abs_path] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': digest.hexdigest()
+        }
+    return digest.hexdigest()
+
+def cache_key_for(sha256):
+    """Chave do cache: conteúdo da mídia + parâmetros que alteram o resultado"""
+    return f"{sha256}:{LANGUAGE_CODE}:{MEDIA_FORMAT}"
+
+def reuse_cached_transcription(file_name, cache_key):
+    """Reaproveita .txt/.json já gerados para a mesma mídia; retorna True em caso de acerto"""
+    with cache_lock:
+        entry = cache['transcriptions'].get(cache_key)
+    if not entry or not os.path.exists(entry['txt']):
+        return False
+    
+    # Tempos por palavra solicitados mas ausentes no cache (ou no formato antigo, em float32): transcrever novamente
+    if WORD_TIMINGS and not (entry.get('words') and os.path.exists(os.path.join(entry['words'], 'start_ms.npy'))):
+        return False
+    
+    local_txt = os.path.join(LOCAL_OUTPUT_FOLDER, f'{Path(file_name).stem}.txt')
+    if os.path.abspath(entry['txt']) != os.path.abspath(local_txt):
+        shutil.copyfile(entry['txt'], local_txt)
+    
+    words_dir = os.path.join(LOCAL_OUTPUT_FOLDER, f'{Path(file_name).stem}.words')
+    if WORD_TIMINGS and os.path.abspath(entry['words']) != os.path.abspath(words_dir):
+        shutil.copytree(entry['words'], words_dir, dirs_exist_ok=True)
+    return True
+
+# Cache compartilhado entre as threads de upload
+cache_lock = threading.Lock()
+cache = load_cache()
+
 # Ler arquivos do CSV com pandas
 df = pd.read_csv(INPUT_CSV)
 files_to_process = df[FILE_PATH_COLUMN].tolist()
 
 print(f"Encontrados {len(files_to_process)} arquivos para processar")
 
-# 1. Upload de todos os arquivos
-print("\n=== Iniciando uploads ===")
-for file_path in files_to_process:
-    if not os.path.exists(file_path):
-        print(f"Arquivo {file_path} não encontrado, pulando...")
-        continue
-    
+# Instante de início da execução (referência para os tempos por arquivo)
+run_start = time.monotonic()
+
+# Tempos por arquivo, indexados pelo nome do arquivo
+timings = {}
+
+def upload_media(file_path, queued_cache_key):
+    """Faz upload de um arquivo (ou reaproveita o cache); retorna 'cached' ou 'uploaded'"""
     file_name = os.path.basename(file_path)
     s3_key = f"{S3_INPUT_PREFIX}{file_name}"
+    timing = timings[file_name]
+    
+    # Pular upload e job se a mesma mídia já foi transcrita com as mesmas configurações
+    timing['cache_key'] = cache_key_for(file_sha256(file_path))
+    if reuse_cached_transcription(file_name, timing['cache_key']):
+        timing['cached'] = True
+        print(f"[CACHE] {file_name} já transcrito, reaproveitando {Path(file_name).stem}.txt")
+        return 'cached'
+    
+    # Upload já concluído em uma execução anterior interrompida
+    if queued_cache_key == timing['cache_key']:
+        print(f"[OK] {file_name} já enviado em execução anterior")
+        return 'uploaded'
     
     print(f"Uploading {file_name}...")
-    s3_client.upload_file(
-        Filename=file_path,
-        Bucket=BUCKET_NAME,
-        Key=s3_key
-    )
+    timing['upload_start'] = time.monotonic()
+    if RESUMABLE_UPLOAD and timing['size'] >= transfer_config.multipart_threshold:
+        resumable_upload(
+            s3_client,
+            file_path,
+            BUCKET_NAME,
+            s3_key,
+            transfer_config.multipart_chunksize,
+            checkpoint_path_for(file_name),
+            max_workers=UPLOAD_MAX_CONCURRENCY
+        )
+    else:
+        s3_client.upload_file(
+            Filename=file_path,
+            Bucket=BUCKET_NAME,
+            Key=s3_key,
+            Config=transfer_config
+        )
+    timing['upload_end'] = time.monotonic()
     print(f"[OK] {file_name} enviado")
+    return 'uploaded'
 
-# 2. Iniciar jobs de transcrição
-print("\n=== Iniciando jobs de transcrição ===")
-jobs = {}
-for file_path in files_to_process:
-    if not os.path.exists(file_path):
-        continue
-    
-    file_name = os.path.basename(file_path)
+def start_job(job_name, file_name):
+    """Inicia o job de transcrição de um arquivo já enviado ao S3"""
     s3_key = f"{S3_INPUT_PREFIX}{file_name}"
-    job_name = f"transcribe-{Path(file_name).stem}-{int(time.time())}"
-    
     print(f"Iniciando job: {job_name}")
-    transcribe_client.start_transcription_job(
-        TranscriptionJobName=job_name,
-        Media={'MediaFileUri': f's3://{BUCKET_NAME}/{s3_key}'},
-        MediaFormat=MEDIA_FORMAT,
-        LanguageCode=LANGUAGE_CODE,
-        OutputBucketName=BUCKET_NAME,
-        OutputKey=S3_OUTPUT_PREFIX
-    )
-    
-    jobs[job_name] = file_name
+    try:
+        transcribe_client.start_transcription_job(
+            TranscriptionJobName=job_name,
+            Media={'MediaFileUri': f's3://{BUCKET_NAME}/{s3_key}'},
+            MediaFormat=MEDIA_FORMAT,
+            LanguageCode=LANGUAGE_CODE,
+            OutputBucketName=BUCKET_NAME,
+            OutputKey=S3_OUTPUT_PREFIX
+        )
+    except ClientError as e:
+        # Job com este nome já existe: foi iniciado antes de uma interrupção
+        if e.response['Error']['Code'] != 'ConflictException':
+            raise
+    timings[file_name]['job_start'] = time.monotonic()
     print(f"[OK] Job {job_name} iniciado")
 
-# 3. Aguardar conclusão dos jobs
-print("\n=== Aguardando conclusão dos jobs ===")
-pending_jobs = set(jobs.keys())
+def job_exists(job_name):
+    """Verifica se um job foi de fato criado (usado ao retomar uma execução)"""
+    try:
+        transcribe_client.get_transcription_job(TranscriptionJobName=job_name)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('BadRequestException', 'NotFoundException'):
+            return False
+        raise
+
+def discover_job_limit():
+    """Define o máximo de jobs simultâneos pelo .env ou pela cota do Service Quotas"""
+    if MAX_CONCURRENT_JOBS > 0:
+        return MAX_CONCURRENT_JOBS
+    
+    try:
+        quotas_client = boto3.client('service-quotas')
+        params = {'ServiceCode': 'transcribe'}
+        while True:
+            page = quotas_client.list_service_quotas(**params)
+            for quota in page.get('Quotas', []):
+                name = quota['QuotaName'].lower()
+                if ('concurrent' in name and 'transcription job' in name
+                        and 'medical' not in name and 'analytics' not in name):
+                    print(f"Cota da conta: {quota['QuotaName']} = {int(quota['Value'])}")
+                    return int(quota['Value'])
+            if not page.get('NextToken'):
+                break
+            params['NextToken'] = page['NextToken']
+    except Exception as e:
+        print(f"[AVISO] Não foi possível consultar a cota de jobs simultâneos: {e}")
+    
+    return DEFAULT_CONCURRENT_JOBS
+
+def start_retry_delay(attempt):
+    """Backoff exponencial com jitter completo para inícios limitados pela AWS"""
+    return random.uniform(0, min(START_RETRY_MAX_SECONDS, START_RETRY_BASE_SECONDS * (2 ** attempt)))
+
+def load_queue():
+    """Carrega a fila persistente de uma execução anterior"""
+    if os.path.exists(QUEUE_FILE):
+        try:
+            with open(QUEUE_FILE, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"[AVISO] Fila {QUEUE_FILE} inválida, ignorando: {e}")
+    return {}
+
+def save_queue():
+    """Salva a fila de forma atômica (arquivo temporário + rename)"""
+    temp_file = QUEUE_FILE + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(queue_state, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, QUEUE_FILE)
 
-while pending_jobs:
-    print(f"\nJobs pendentes: {len(pending_jobs)}")
-    completed = []
+def format_seconds(value):
+    """Formata segundos para exibição no resumo"""
+    return f"{value:.1f}s" if value is not None else "-"
+
+def list_active_jobs():
+    """Lista em lote (paginado) os jobs deste script ainda na fila ou em processamento"""
+    active = set()
+    for status in ('QUEUED', 'IN_PROGRESS'):
+        params = {'Status': status, 'JobNameContains': JOB_NAME_PREFIX, 'MaxResults': 100}
+        while True:
+            page = transcribe_client.list_transcription_jobs(**params)
+            for summary in page.get('TranscriptionJobSummaries', []):
+                active.add(summary['TranscriptionJobName'])
+            if not page.get('NextToken'):
+                break
+            params['NextToken'] = page['NextToken']
+    return active
+
+def poll_finished_jobs(pending_jobs):
+    """Retorna {job: status} dos jobs pendentes que terminaram"""
+    # A listagem em lote cobre todos os jobs ativos com poucas chamadas; apenas os jobs
+    # que saíram da fila/processamento são confirmados individualmente (uma vez cada)
+    active = list_active_jobs()
+    finished = {}
+    for job_name in pending_jobs - active:
+        response = transcribe_client.get_transcription_job(TranscriptionJobName=job_name)
+        status = response['TranscriptionJob']['TranscriptionJobStatus']
+        if status in ('COMPLETED', 'FAILED'):
+            finished[job_name] = status
+    return finished
+
+def next_poll_delay(pending_count, idle_cycles):
+    """Intervalo adaptativo: cresce com o tamanho da fila e dobra a cada ciclo sem jobs concluídos"""
+    pages = 1 + pending_count // 100
+    return min(POLL_MAX_SECONDS, POLL_MIN_SECONDS * pages * (2 ** min(idle_cycles, 10)))
+
+def new_word_columns():
+    """Colunas vazias da tabela de palavras (arrays compactos, sem um objeto por item)"""
+    return {
+        'start': array('i'),
+        'end': array('i'),
+        'confidence': array('f'),
+        'offsets': array('q', [0]),
+        'tokens': bytearray()
+    }
+
+def append_word_item(columns, item):
+    """Adiciona um item do Transcribe; pontuação é anexada ao token anterior"""
+    alternative = item['alternatives'][0]
+    token = alternative['content'].encode('utf-8')
     
-    for job_name in pending_jobs:
-        status_response = transcribe_client.get_transcription_job(
-            TranscriptionJobName=job_name
-        )
-        status = status_response['TranscriptionJob']['TranscriptionJobStatus']
-        
-        if status == 'COMPLETED':
-            print(f"[OK] {job_name} concluído")
-            completed.append(job_name)
-        elif status == 'FAILED':
-            print(f"[ERRO] {job_name} falhou")
-            completed.append(job_name)
-        else:
-            print(f"{job_name} ainda processando...")
+    if item.get('type') == 'punctuation':
+        if len(columns['offsets']) > 1:
+            columns['tokens'] += token
+            columns['offsets'][-1] += len(token)
+        return
     
-    # Remover jobs concluídos
-    for job_name in completed:
-        pending_jobs.remove(job_name)
+    # Tempos em milissegundos inteiros (float32 perde precisão em gravações longas)
+    columns['start'].append(round(float(item['start_time']) * 1000))
+    columns['end'].append(round(float(item['end_time']) * 1000))
+    columns['confidence'].append(float(alternative.get('confidence') or 0))
+    columns['tokens'] += token
+    columns['offsets'].append(len(columns['tokens']))
+
+def word_item_sink(columns):
+    """Coroutine que recebe itens do parser incremental e os grava nas colunas"""
+    while True:
+        append_word_item(columns, (yield))
+
+def save_word_timings(columns, words_dir):
+    """Grava a tabela de palavras: start_ms/end_ms (int32), confidence (float32), offsets (int64) e tokens.bin"""
+    temp_dir = words_dir + ".tmp"
+    os.makedirs(temp_dir, exist_ok=True)
+    np.save(os.path.join(temp_dir, 'start_ms.npy'), np.frombuffer(columns['start'], dtype=np.int32))
+    np.save(os.path.join(temp_dir, 'end_ms.npy'), np.frombuffer(columns['end'], dtype=np.int32))
+    np.save(os.path.join(temp_dir, 'confidence.npy'), np.frombuffer(columns['confidence'], dtype=np.float32))
+    np.save(os.path.join(temp_dir, 'offsets.npy'), np.frombuffer(columns['offsets'], dtype=np.int64))
+    with open(os.path.join(temp_dir, 'tokens.bin'), 'wb') as f:
+        f.write(columns['tokens'])
     
-    if pending_jobs:
-        time.sleep(10)
+    if os.path.exists(words_dir):
+        shutil.rmtree(words_dir)
+    os.replace(temp_dir, words_dir)
+
+def stream_transcript(s3_output_key, local_json_gz, word_columns=None):
+    """Extrai o texto da transcrição lendo o JSON do S3 em blocos, sem carregar a lista de itens"""
+    transcripts = ijson.sendable_list()
+    parsers = [ijson.items_coro(transcripts, 'results.transcripts.item.transcript')]
+    if word_columns is not None:
+        sink = word_item_sink(word_columns)
+        next(sink)
+        parsers.append(ijson.items_coro(sink, 'results.items.item'))
+    body = s3_client.get_object(Bucket=BUCKET_NAME, Key=s3_output_key)['Body']
+    json_file = gzip.open(local_json_gz, 'wb') if local_json_gz else None
+    
+    try:
+        for chunk in body.iter_chunks(chunk_size=STREAM_CHUNK_SIZE):
+            if json_file:
+                json_file.write(chunk)
+            for parser in parsers:
+                parser.send(chunk)
+            # Sem cópia local nem tempos por palavra, o restante do objeto não precisa ser lido
+            if transcripts and not json_file and word_columns is None:
+                break
+        else:
+            for parser in parsers:
+                parser.close()
+    finally:
+        body.close()
+        if json_file:
+            json_file.close()
+    
+    if not transcripts:
+        raise ValueError(f"Transcrição não encontrada em {s3_output_key}")
+    return transcripts[0]
 
-# 4. Download e extração das transcrições
-print("\n=== Baixando transcrições ===")
-for job_name, file_name in jobs.items():
+def download_transcript(job_name, file_name):
+    """Baixa o JSON de um job concluído e extrai o texto da transcrição"""
     s3_output_key = f'{S3_OUTPUT_PREFIX}{job_name}.json'
     local_json = os.path.join(LOCAL_OUTPUT_FOLDER, f'{job_name}.json')
     local_txt = os.path.join(LOCAL_OUTPUT_FOLDER, f'{Path(file_name).stem}.txt')
+    words_dir = os.path.join(LOCAL_OUTPUT_FOLDER, f'{Path(file_name).stem}.words') if WORD_TIMINGS else None
+    word_columns = new_word_columns() if WORD_TIMINGS else None
     
     try:
-        # Download do JSON
-        s3_client.download_file(
-            Bucket=BUCKET_NAME,
-            Key=s3_output_key,
-            Filename=local_json
-        )
-        
-        # Extrair texto
-        with open(local_json, 'r', encoding='utf-8') as f:
-            transcription_data = json.load(f)
+        if STREAM_RESULTS:
+            # JSON completo opcional e, quando mantido, gravado comprimido
+            local_json = local_json + '.gz' if KEEP_JSON else None
+            transcript_text = stream_transcript(s3_output_key, local_json, word_columns)
+        else:
+            # Download do JSON
+            s3_client.download_file(
+                Bucket=BUCKET_NAME,
+                Key=s3_output_key,
+                Filename=local_json
+            )
+            
+            # Extrair texto
+            with open(local_json, 'r', encoding='utf-8') as f:
+                transcription_data = json.load(f)
+            
+            transcript_text = transcription_data['results']['transcripts'][0]['transcript']
+            if WORD_TIMINGS:
+                for item in transcription_data['results'].get('items', []):
+                    append_word_item(word_columns, item)
         
-        transcript_text = transcription_data['results']['transcripts'][0]['transcript']
+        if WORD_TIMINGS:
+            save_word_timings(word_columns, words_dir)
+            print(f"[OK] {file_name} -> {Path(file_name).stem}.words ({len(word_columns['start'])} palavras)")
         
         # Salvar TXT
         with open(local_txt, 'w', encoding='utf-8') as f:
             f.write(transcript_text)
         
         print(f"[OK] {file_name} -> {Path(file_name).stem}.txt")
+        
+        # Registrar no cache para que execuções futuras não transcrevam a mesma mídia
+        with cache_lock:
+            cache['transcriptions'][timings[file_name]['cache_key']] = {
+                'file_name': file_name,
+                'job_name': job_name,
+                'txt': local_txt,
+                'json': local_json,
+                'words': words_dir
+            }
+        save_cache()
+        return True
     except Exception as e:
         print(f"[ERRO] Erro ao processar {job_name}: {e}")
+        return False
+
+# 1. Upload e início dos jobs em pipeline (cada job inicia assim que seu upload termina
+#    e há vaga), acompanhando o status em lote e baixando cada transcrição assim que conclui
+max_job_limit = discover_job_limit()
+job_limit = max_job_limit
+print(f"\n=== Enviando arquivos e iniciando jobs ({UPLOAD_WORKERS} uploads simultâneos, até {job_limit} jobs em andamento) ===")
+
+# Estado de cada arquivo na fila persistente: uploaded -> starting -> started
+queue_state = load_queue()
+if queue_state:
+    print(f"Retomando execução anterior: {len(queue_state)} arquivos na fila")
+
+jobs = {}
+valid_files = []
+ready = deque()
+pending_jobs = set()
+for file_path in files_to_process:
+    if not os.path.exists(file_path):
+        print(f"Arquivo {file_path} não encontrado, pulando...")
+        continue
+    file_name = os.path.basename(file_path)
+    timings[file_name] = {'size': os.path.getsize(file_path)}
+    
+    # Jobs iniciados antes da interrupção voltam direto para o acompanhamento
+    entry = queue_state.get(os.path.abspath(file_path))
+    if entry and entry['state'] in ('starting', 'started'):
+        timings[file_name]['cache_key'] = entry['cache_key']
+        if entry['state'] == 'started' or job_exists(entry['job_name']):
+            entry['state'] = 'started'
+            jobs[entry['job_name']] = file_name
+            pending_jobs.add(entry['job_name'])
+            print(f"[OK] Job {entry['job_name']} retomado")
+        else:
+            ready.append({'file_path': file_path, 'attempt': 0, 'not_before': 0})
+        continue
+    valid_files.append(file_path)
+
+upload_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+download_executor = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+upload_futures = {}
+for file_path in valid_files:
+    entry = queue_state.get(os.path.abspath(file_path))
+    queued_cache_key = entry['cache_key'] if entry else None
+    upload_futures[upload_executor.submit(upload_media, file_path, queued_cache_key)] = file_path
+download_futures = {}
+idle_cycles = 0
+next_poll_at = 0
+
+while upload_futures or ready or pending_jobs or download_futures:
+    # 2. Enfileirar arquivos cujos uploads terminaram
+    for future in [f for f in upload_futures if f.done()]:
+        file_path = upload_futures.pop(future)
+        file_name = os.path.basename(file_path)
+        try:
+            if future.result() == 'uploaded':
+                queue_state[os.path.abspath(file_path)] = {
+                    'file_name': file_name,
+                    'cache_key': timings[file_name]['cache_key'],
+                    'state': 'uploaded',
+                    'job_name': None
+                }
+                save_queue()
+                ready.append({'file_path': file_path, 'attempt': 0, 'not_before': 0})
+        except Exception as e:
+            print(f"[ERRO] Falha no upload de {file_name}: {e}")
+    
+    # 3. Iniciar jobs enquanto houver vaga (controle de admissão)
+    while ready and len(pending_jobs) < job_limit and ready[0]['not_before'] <= time.monotonic():
+        item = ready.popleft()
+        entry = queue_state[os.path.abspath(item['file_path'])]
+        file_name = entry['file_name']
+        
+        # Nome do job gravado antes da chamada: se o processo cair, a retomada não duplica o job
+        if not entry['job_name']:
+            entry['job_name'] = f"{JOB_NAME_PREFIX}{Path(file_name).stem}-{int(time.time())}"
+        entry['state'] = 'starting'
+        save_queue()
+        
+        try:
+            start_job(entry['job_name'], file_name)
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code not in ('LimitExceededException', 'ThrottlingException'):
+                print(f"[ERRO] Falha ao iniciar job de {file_name}: {error_code}")
+                del queue_state[os.path.abspath(item['file_path'])]
+                save_queue()
+                continue
+            
+            # Cota atingida (inclui jobs de outras origens na conta): reduzir limite e tentar depois
+            if error_code == 'LimitExceededException' and pending_jobs:
+                job_limit = max(1, len(pending_jobs))
+            delay = start_retry_delay(item['attempt'])
+            print(f"[AVISO] {error_code} ao iniciar {file_name}, nova tentativa em {delay:.1f}s")
+            item['attempt'] += 1
+            item['not_before'] = time.monotonic() + delay
+            ready.appendleft(item)
+            break
+        
+        entry['state'] = 'started'
+        save_queue()
+        jobs[entry['job_name']] = file_name
+        pending_jobs.add(entry['job_name'])
+        
+        # Início aceito: recuperar o limite reduzido por LimitExceededException (+1 por job, até a cota)
+        if job_limit < max_job_limit:
+            job_limit += 1
+    
+    # 4. Consultar status em lote e baixar imediatamente as transcrições concluídas
+    if pending_jobs and time.monotonic() >= next_poll_at:
+        try:
+            finished = poll_finished_jobs(pending_jobs)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ThrottlingException':
+                raise
+            print("[AVISO] Consulta de status limitada pela AWS, aumentando intervalo...")
+            finished = {}
+        
+        for job_name, status in finished.items():
+            file_name = jobs[job_name]
+            timings[file_name]['job_end'] = time.monotonic()
+            pending_jobs.remove(job_name)
+            if status == 'COMPLETED':
+                print(f"[OK] {job_name} concluído")
+                download_futures[download_executor.submit(download_transcript, job_name, file_name)] = job_name
+            else:
+                print(f"[ERRO] {job_name} falhou")
+                queue_state.pop(next(k for k, v in queue_state.items() if v['job_name'] == job_name), None)
+                save_queue()
+        
+        idle_cycles = 0 if finished else idle_cycles + 1
+        next_poll_at = time.monotonic() + next_poll_delay(len(pending_jobs), idle_cycles)
+        if pending_jobs or ready:
+            print(f"Jobs em andamento: {len(pending_jobs)}/{job_limit} | na fila: {len(ready)} | uploads em andamento: {len(upload_futures)}")
+    
+    # 5. Retirar da fila persistente os arquivos com transcrição salva
+    for future in [f for f in download_futures if f.done()]:
+        job_name = download_futures.pop(future)
+        if future.result():
+            queue_state.pop(next(k for k, v in queue_state.items() if v['job_name'] == job_name), None)
+            save_queue()
+    
+    # Aguardar o próximo evento: fim de upload, vaga para nova tentativa, consulta ou download
+    deadlines = []
+    if pending_jobs:
+        deadlines.append(next_poll_at)
+    if ready and len(pending_jobs) < job_limit:
+        deadlines.append(ready[0]['not_before'])
+    timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+    waitables = list(upload_futures) + list(download_futures)
+    if waitables:
+        wait(waitables, timeout=timeout, return_when=FIRST_COMPLETED)
+    elif timeout:
+        time.sleep(timeout)
+
+upload_executor.shutdown()
+download_executor.shutdown()
+
+# Limpar uploads multipart interrompidos que não serão mais retomados
+if RESUMABLE_UPLOAD:
+    try:
+        aborted = abort_stale_uploads(s3_client, BUCKET_NAME, S3_INPUT_PREFIX, STALE_UPLOAD_HOURS)
+        if aborted:
+            print(f"[OK] {aborted} uploads multipart antigos abortados")
+    except ClientError as e:
+        print(f"[AVISO] Não foi possível limpar uploads multipart antigos: {e}")
+
+# Persistir hashes calculados nesta execução
+save_cache()
+
+# 4. Resumo de tempos por arquivo
+print("\n=== Tempos por arquivo ===")
+print(f"{'Arquivo':<40} {'MB':>8} {'Upload':>9} {'Início job':>11} {'Transcrição':>12} {'Cache':>6}")
+for file_name, timing in sorted(timings.items()):
+    upload_time = None
+    job_start_offset = None
+    job_time = None
+    if 'upload_end' in timing:
+        upload_time = timing['upload_end'] - timing['upload_start']
+    if 'job_start' in timing:
+        job_start_offset = timing['job_start'] - run_start
+    if 'job_end' in timing and 'job_start' in timing:
+        job_time = timing['job_end'] - timing['job_start']
+    print(
+        f"{file_name[:40]:<40} {timing['size'] / (1024*1024):>8.1f} "
+        f"{format_seconds(upload_time):>9} {format_seconds(job_start_offset):>11} {format_seconds(job_time):>12} "
+        f"{'sim' if timing.get('cached') else 'não':>6}"
+    )
+
+# Comparar com o fluxo sequencial (todos os uploads antes do primeiro job)
+total_upload_time = sum(
+    t['upload_end'] - t['upload_start'] for t in timings.values() if 'upload_end' in t
+)
+job_starts = [t['job_start'] - run_start for t in timings.values() if 'job_start' in t]
+print(f"\nTempo total de execução: {time.monotonic() - run_start:.1f}s")
+print(f"Soma dos tempos de upload: {total_upload_time:.1f}s")
+print(f"Arquivos reaproveitados do cache: {sum(1 for t in timings.values() if t.get('cached'))}/{len(timings)}")
+if job_starts:
+    print(f"Primeiro job iniciado após {min(job_starts):.1f}s (no fluxo sequencial: após {total_upload_time:.1f}s)")
 
 print("\n=== Processamento concluído ===")
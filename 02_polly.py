@@ -2,10 +2,20 @@ try:
     import os
     import re
     import sys
+    import time
+    import json
+    import random
+    import shutil
+    import hashlib
+    import tempfile
+    import threading
     from pathlib import Path
     from collections import defaultdict
+    from concurrent.futures import Future, ThreadPoolExecutor
+    from urllib.parse import urlparse, unquote
     import boto3
-    from botocore.exceptions import NoCredentialsError
+    from botocore.config import Config
+    from botocore.exceptions import ClientError, NoCredentialsError
     from dotenv import load_dotenv
 except ModuleNotFoundError as e:
     print(f"Erro: {e}")
@@ -27,6 +37,49 @@ LANGUAGE_CODE = os.getenv('POLLY_LANGUAGE_CODE')
 ENGINE = os.getenv('POLLY_ENGINE')
 OUTPUT_FORMAT = os.getenv('POLLY_OUTPUT_FORMAT')
 
+# Síntese paralela com limite de requisições por segundo (cota de TPS do engine)
+POLLY_WORKERS = int(os.getenv('POLLY_WORKERS', 4))
+POLLY_MAX_TPS = float(os.getenv('POLLY_MAX_TPS', 8))
+POLLY_MAX_RETRIES = int(os.getenv('POLLY_MAX_RETRIES', 5))
+RETRY_BASE_SECONDS = 1
+RETRY_MAX_SECONDS = 30
+
+# Cache de áudios por conteúdo (texto + voz + engine + idioma + formato), com limite de tamanho (LRU)
+CACHE_FOLDER = os.getenv('POLLY_CACHE_FOLDER', os.path.join(OUTPUT_FOLDER or 'output', 'polly_cache'))
+CACHE_MAX_MB = float(os.getenv('POLLY_CACHE_MAX_MB', 1024))
+
+# Textos longos são divididos em frases até o limite de caracteres por requisição
+MAX_CHARS = int(os.getenv('POLLY_MAX_CHARS', 3000))
+COMPILE_AUDIO = os.getenv('POLLY_COMPILE_AUDIO', 'True').lower() == 'true'
+STREAM_READ_SIZE = 64 * 1024
+
+# Modo de síntese: sync (synthesize_speech), async (tarefas gravando no S3) ou auto (pelo tamanho do texto)
+SYNTHESIS_MODE = os.getenv('POLLY_SYNTHESIS_MODE', 'sync').lower()
+ASYNC_THRESHOLD_CHARS = int(os.getenv('POLLY_ASYNC_THRESHOLD_CHARS', 20000))
+ASYNC_MAX_CHARS = 100000
+BUCKET_NAME = os.getenv('POLLY_BUCKET_NAME')
+S3_OUTPUT_PREFIX = os.getenv('POLLY_S3_OUTPUT_PREFIX', 'polly/')
+POLL_SECONDS = float(os.getenv('POLLY_POLL_SECONDS', 5))
+
+# Legendas (SRT/VTT) a partir das speech marks do Polly, geradas na mesma execução
+SUBTITLES = os.getenv('POLLY_SUBTITLES', 'False').lower() == 'true'
+SUBTITLE_MAX_CHARS = int(os.getenv('POLLY_SUBTITLE_MAX_CHARS', 84))
+SPEECH_MARK_TYPES = ['sentence', 'word']
+PCM_SAMPLE_RATE = 16000
+
+# Validar modo de síntese
+VALID_MODES = ['sync', 'async', 'auto']
+if SYNTHESIS_MODE not in VALID_MODES:
+    print(f"ERRO: POLLY_SYNTHESIS_MODE inválido: '{SYNTHESIS_MODE}'")
+    print(f"Valores válidos: {', '.join(VALID_MODES)}")
+    exit(1)
+if SYNTHESIS_MODE != 'sync' and not BUCKET_NAME:
+    print("ERRO: POLLY_BUCKET_NAME é obrigatório nos modos async e auto")
+    exit(1)
+if POLLY_MAX_TPS <= 0:
+    print(f"ERRO: POLLY_MAX_TPS deve ser maior que zero: '{POLLY_MAX_TPS}'")
+    exit(1)
+
 def check_aws_credentials():
     """Verifica se há credenciais AWS válidas"""
     try:
@@ -51,9 +104,392 @@ check_aws_credentials()
 
 # Criar pasta de output
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+
+# Inicializar clientes (um único cliente compartilhado, com pool para todas as threads)
+polly_client = boto3.client('polly', config=Config(max_pool_connections=max(10, POLLY_WORKERS)))
+s3_client = None
+if SYNTHESIS_MODE != 'sync':
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=max(10, POLLY_WORKERS)))
+
+# Token bucket compartilhado entre as threads (capacidade mínima de 1 para cotas fracionárias, ex.: 0.5 TPS)
+BUCKET_CAPACITY = max(1.0, POLLY_MAX_TPS)
+bucket_lock = threading.Lock()
+bucket_state = {'tokens': BUCKET_CAPACITY, 'updated': time.monotonic()}
+
+def acquire_token():
+    """Bloqueia até haver capacidade para uma requisição dentro de POLLY_MAX_TPS"""
+    while True:
+        with bucket_lock:
+            now = time.monotonic()
+            elapsed = now - bucket_state['updated']
+            bucket_state['tokens'] = min(BUCKET_CAPACITY, bucket_state['tokens'] + elapsed * POLLY_MAX_TPS)
+            bucket_state['updated'] = now
+            if bucket_state['tokens'] >= 1:
+                bucket_state['tokens'] -= 1
+                return
+            wait_time = (1 - bucket_state['tokens']) / POLLY_MAX_TPS
+        time.sleep(wait_time)
+
+def call_with_retry(operation, **params):
+    """Chama uma operação do Polly respeitando o token bucket e repetindo em ThrottlingException"""
+    for attempt in range(POLLY_MAX_RETRIES + 1):
+        acquire_token()
+        try:
+            return operation(**params)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ThrottlingException' or attempt == POLLY_MAX_RETRIES:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** attempt)))
+            print(f"[AVISO] Limite do Polly atingido, nova tentativa em {delay:.1f}s")
+            time.sleep(delay)
+
+# Contadores do cache compartilhados entre as threads
+cache_lock = threading.Lock()
+cache_stats = {'hits': 0, 'misses': 0}
+
+def cache_path_for(text):
+    """Caminho no cache para o áudio de um texto com as configurações atuais de voz"""
+    key_data = json.dumps([text, VOICE_ID, ENGINE, LANGUAGE_CODE, OUTPUT_FORMAT], ensure_ascii=False)
+    key = hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_FOLDER, f"{key}.{OUTPUT_FORMAT}")
+
+def marks_cache_path_for(cached_audio):
+    """Caminho no cache das speech marks (tempos relativos ao início da seção)"""
+    return f"{os.path.splitext(cached_audio)[0]}.marks.json"
+
+def link_or_copy(source, destination):
+    """Cria hard link do cache para a saída (ou copia, se o sistema de arquivos não suportar)"""
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def evict_cache():
+    """Remove os áudios usados há mais tempo até o cache caber em POLLY_CACHE_MAX_MB"""
+    entries = []
+    for name in os.listdir(CACHE_FOLDER):
+        path = os.path.join(CACHE_FOLDER, name)
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total_size = sum(size for _, size, _ in entries)
+    max_size = CACHE_MAX_MB * 1024 * 1024
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(path)
+        total_size -= size
+        removed += 1
+    return removed, total_size
+
+def split_text(text, max_chars):
+    """Divide o texto em blocos de até max_chars, quebrando em fim de frase sempre que possível"""
+    if len(text) <= max_chars:
+        return [text]
+    
+    # Frases maiores que o limite são quebradas em espaços (ou no limite, se não houver)
+    pieces = []
+    for sentence in re.split(r'(?<=[.!?…])\s+', text):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(' ', 0, max_chars + 1)
+            cut = cut if cut > 0 else max_chars
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            pieces.append(sentence)
+    
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+def write_stream(stream, destination):
+    """Grava um stream de áudio em disco com leituras de tamanho limitado"""
+    with open(destination, 'wb') as f:
+        for block in iter(lambda: stream.read(STREAM_READ_SIZE), b''):
+            f.write(block)
+    stream.close()
+
+def concatenate_files(sources, destination):
+    """Concatena arquivos de áudio com cópias em blocos (sem carregar tudo na memória)"""
+    temp_file = f"{destination}.{threading.get_ident()}.tmp"
+    with open(temp_file, 'wb') as out:
+        for source in sources:
+            with open(source, 'rb') as f:
+                shutil.copyfileobj(f, out, STREAM_READ_SIZE)
+    os.replace(temp_file, destination)
+
+def synthesis_params(text, speech_marks):
+    """Parâmetros de síntese: áudio ou speech marks (JSON Lines) do mesmo texto"""
+    params = {
+        'Text': text,
+        'OutputFormat': 'json' if speech_marks else OUTPUT_FORMAT,
+        'VoiceId': VOICE_ID,
+        'LanguageCode': LANGUAGE_CODE,
+        'Engine': ENGINE
+    }
+    if speech_marks:
+        params['SpeechMarkTypes'] = SPEECH_MARK_TYPES
+    return params
+
+def synthesize_chunk(text, destination, speech_marks=False):
+    """Gera o áudio (ou as speech marks) de um bloco de texto e grava em destination"""
+    response = call_with_retry(polly_client.synthesize_speech, **synthesis_params(text, speech_marks))
+    write_stream(response['AudioStream'], destination)
+    return destination
+
+# Tabelas de cabeçalho MP3 Layer III (bitrate em kbps por versão)
+MP3_BITRATES = {
+    'mpeg1': [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    'mpeg2': [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+MP3_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+def mp3_duration_ms(path):
+    """Duração de um MP3 somando os frames (lê apenas os cabeçalhos)"""
+    duration = 0.0
+    with open(path, 'rb') as f:
+        header = f.read(10)
+        # Pular tag ID3v2, se houver
+        if header[:3] == b'ID3':
+            tag_size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+            f.seek(10 + tag_size)
+        else:
+            f.seek(0)
+        
+        while True:
+            position = f.tell()
+            header = f.read(4)
+            if len(header) < 4:
+                break
+            if header[0] != 0xFF or (header[1] & 0xE0) != 0xE0:
+                # Byte fora de sincronia: avançar até o próximo cabeçalho
+                f.seek(position + 1)
+                continue
+            version = (header[1] >> 3) & 3
+            bitrate_index = header[2] >> 4
+            sample_rate_index = (header[2] >> 2) & 3
+            if version == 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+                f.seek(position + 1)
+                continue
+            
+            bitrate = MP3_BITRATES['mpeg1' if version == 3 else 'mpeg2'][bitrate_index] * 1000
+            sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+            samples = 1152 if version == 3 else 576
+            padding = (header[2] >> 1) & 1
+            frame_length = samples // 8 * bitrate // sample_rate + padding
+            duration += samples * 1000 / sample_rate
+            f.seek(position + frame_length)
+    return duration
+
+def ogg_duration_ms(path):
+    """Duração de um Ogg Vorbis pela posição (granule) da última página"""
+    with open(path, 'rb') as f:
+        first_page = f.read(64)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - 65536))
+        tail = f.read()
+    
+    # Cabeçalho de identificação Vorbis: taxa de amostragem após "\x01vorbis" + versão + canais
+    header_start = first_page.find(b'\x01vorbis')
+    last_page = tail.rfind(b'OggS')
+    if header_start < 0 or last_page < 0:
+        return None
+    sample_rate = int.from_bytes(first_page[header_start + 12:header_start + 16], 'little')
+    granule = int.from_bytes(tail[last_page + 6:last_page + 14], 'little')
+    return granule * 1000 / sample_rate if sample_rate else None
+
+def audio_duration_ms(path):
+    """Duração do áudio em milissegundos, conforme POLLY_OUTPUT_FORMAT"""
+    if OUTPUT_FORMAT == 'mp3':
+        return mp3_duration_ms(path)
+    if OUTPUT_FORMAT == 'ogg_vorbis':
+        return ogg_duration_ms(path)
+    if OUTPUT_FORMAT == 'pcm':
+        # PCM 16 bits mono
+        return os.path.getsize(path) / 2 / PCM_SAMPLE_RATE * 1000
+    return None
+
+def load_marks(path):
+    """Lê as speech marks (uma por linha, JSON Lines)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def build_cues(marks, total_ms):
+    """Converte speech marks em legendas: uma por frase, quebrando frases longas pelas palavras"""
+    sentences = [m for m in marks if m['type'] == 'sentence']
+    words = [m for m in marks if m['type'] == 'word']
+    cues = []
+    
+    for index, sentence in enumerate(sentences):
+        sentence_end = sentences[index + 1]['time'] if index + 1 < len(sentences) else total_ms
+        sentence_words = [w for w in words if sentence['time'] <= w['time'] < sentence_end]
+        
+        if len(sentence['value']) <= SUBTITLE_MAX_CHARS or not sentence_words:
+            cues.append((sentence['time'], sentence_end, sentence['value']))
+            continue
+        
+        # Agrupar palavras em linhas de até SUBTITLE_MAX_CHARS caracteres
+        groups = [[]]
+        for word in sentence_words:
+            line = ' '.join(w['value'] for w in groups[-1] + [word])
+            if groups[-1] and len(line) > SUBTITLE_MAX_CHARS:
+                groups.append([])
+            groups[-1].append(word)
+        for group_index, group in enumerate(groups):
+            start = group[0]['time'] if group_index else sentence['time']
+            end = groups[group_index + 1][0]['time'] if group_index + 1 < len(groups) else sentence_end
+            cues.append((start, end, ' '.join(w['value'] for w in group)))
+    return cues
+
+def format_timestamp(ms, separator):
+    """Formata milissegundos como HH:MM:SS,mmm (SRT) ou HH:MM:SS.mmm (VTT)"""
+    ms = int(round(ms))
+    hours, ms = divmod(ms, 3600000)
+    minutes, ms = divmod(ms, 60000)
+    seconds, ms = divmod(ms, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{separator}{ms:03d}"
 
-# Inicializar cliente Polly
-polly_client = boto3.client('polly')
+def write_subtitles(marks, total_ms, base_path):
+    """Salva as legendas em base_path.srt e base_path.vtt"""
+    cues = build_cues(marks, total_ms)
+    with open(f"{base_path}.srt", 'w', encoding='utf-8') as f:
+        for index, (start, end, text) in enumerate(cues, 1):
+            f.write(f"{index}\n{format_timestamp(start, ',')} --> {format_timestamp(end, ',')}\n{text}\n\n")
+    with open(f"{base_path}.vtt", 'w', encoding='utf-8') as f:
+        f.write("WEBVTT\n\n")
+        for start, end, text in cues:
+            f.write(f"{format_timestamp(start, '.')} --> {format_timestamp(end, '.')}\n{text}\n\n")
+
+def section_duration_ms(audio_path, marks):
+    """Duração da seção; se o formato não permitir calcular, estima pela última speech mark"""
+    duration = audio_duration_ms(audio_path)
+    if duration:
+        return duration
+    return max((m['time'] for m in marks), default=0) + 1000
+
+def use_async(text):
+    """Define se o texto vai para o modo assíncrono (tarefa no S3) ou síncrono"""
+    if SYNTHESIS_MODE == 'auto':
+        return len(text) > ASYNC_THRESHOLD_CHARS
+    return SYNTHESIS_MODE == 'async'
+
+def start_synthesis_task(client, text, speech_marks=False):
+    """Inicia uma tarefa de síntese assíncrona que grava o áudio no S3; retorna o TaskId"""
+    response = call_with_retry(
+        client.start_speech_synthesis_task,
+        OutputS3BucketName=BUCKET_NAME,
+        OutputS3KeyPrefix=S3_OUTPUT_PREFIX,
+        **synthesis_params(text, speech_marks)
+    )
+    return response['SynthesisTask']['TaskId']
+
+def list_active_tasks(client):
+    """Lista em lote (paginado) as tarefas ainda agendadas ou em processamento"""
+    active = set()
+    for status in ('scheduled', 'inProgress'):
+        params = {'Status': status, 'MaxResults': 100}
+        while True:
+            page = client.list_speech_synthesis_tasks(**params)
+            for task in page.get('SynthesisTasks', []):
+                active.add(task['TaskId'])
+            if not page.get('NextToken'):
+                break
+            params['NextToken'] = page['NextToken']
+    return active
+
+def poll_finished_tasks(client, pending_tasks):
+    """Retorna {TaskId: tarefa} das tarefas pendentes que terminaram"""
+    # Apenas as tarefas que saíram da listagem de ativas são consultadas individualmente
+    finished = {}
+    for task_id in pending_tasks - list_active_tasks(client):
+        task = client.get_speech_synthesis_task(TaskId=task_id)['SynthesisTask']
+        if task['TaskStatus'] in ('completed', 'failed'):
+            finished[task_id] = task
+    return finished
+
+def s3_key_from_uri(uri):
+    """Extrai a chave S3 do OutputUri de uma tarefa (URL no estilo path ou virtual host)"""
+    path = unquote(urlparse(uri).path).lstrip('/')
+    if path.startswith(f"{BUCKET_NAME}/"):
+        path = path[len(BUCKET_NAME) + 1:]
+    return path
+
+def download_task_audio(client, task, destination):
+    """Baixa o áudio de uma tarefa concluída com leituras de tamanho limitado e remove o objeto do S3"""
+    key = s3_key_from_uri(task['OutputUri'])
+    body = client.get_object(Bucket=BUCKET_NAME, Key=key)['Body']
+    write_stream(body, destination)
+    
+    # O áudio já está no disco: não deixar saídas das tarefas acumulando no bucket
+    try:
+        client.delete_object(Bucket=BUCKET_NAME, Key=key)
+    except ClientError as e:
+        print(f"[AVISO] Não foi possível remover s3://{BUCKET_NAME}/{key}: {e.response['Error']['Code']}")
+    return destination
+
+def forward_result(source, target):
+    """Repassa o resultado (ou erro) de um future para outro"""
+    if source.exception():
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+def submit_chunk(text, destination, is_async, speech_marks=False):
+    """Agenda a síntese de um bloco (síncrona no pool ou tarefa assíncrona); retorna um future"""
+    if not is_async:
+        return executor.submit(synthesize_chunk, text, destination, speech_marks)
+    
+    # Modo assíncrono: o future é concluído quando o resultado da tarefa for baixado
+    placeholder = Future()
+    try:
+        task_id = start_synthesis_task(polly_client, text, speech_marks)
+        async_tasks[task_id] = (placeholder, destination)
+    except Exception as e:
+        placeholder.set_exception(e)
+    return placeholder
+
+def assemble_section(file_info):
+    """Junta os blocos de uma seção no cache e liga o resultado à saída"""
+    part_files = [future.result() for future in file_info['chunk_futures']]
+    
+    # Speech marks de cada bloco deslocadas pela duração dos blocos anteriores
+    if SUBTITLES:
+        marks = []
+        offset = 0
+        for part_file, marks_future in zip(part_files, file_info['marks_futures']):
+            chunk_marks = load_marks(marks_future.result())
+            chunk_duration = section_duration_ms(part_file, chunk_marks)
+            for mark in chunk_marks:
+                mark['time'] += offset
+            marks.extend(chunk_marks)
+            offset += chunk_duration
+        with open(marks_cache_path_for(file_info['cached_audio']), 'w', encoding='utf-8') as f:
+            json.dump(marks, f, ensure_ascii=False)
+        file_info['marks'] = marks
+        file_info['duration_ms'] = offset
+    
+    concatenate_files(part_files, file_info['cached_audio'])
+    for part_file in part_files:
+        os.remove(part_file)
+    for marks_future in file_info['marks_futures']:
+        os.remove(marks_future.result())
+    link_or_copy(file_info['cached_audio'], file_info['output_audio'])
+    with cache_lock:
+        cache_stats['misses'] += 1
+    print(f"[OK] Áudio salvo: {file_info['output_audio']}")
 
 # Padrão para identificar arquivos vXXsXX.txt
 pattern = re.compile(r'^v(\d+)s(\d+)\.txt$')
@@ -80,35 +516,123 @@ print(f"Encontrados {len(files_data)} arquivos para processar\n")
 # Agrupar por vídeo para compilação
 videos_content = defaultdict(list)
 
-# Processar cada arquivo
+# Ler conteúdo na ordem (video_id, section_id), mantendo a compilação determinística
 for file_info in files_data:
-    filename = file_info['filename']
-    filepath = file_info['filepath']
-    video_id = file_info['video_id']
-    
-    # Ler conteúdo
-    with open(filepath, 'r', encoding='utf-8') as f:
-        text = f.read().strip()
+    with open(file_info['filepath'], 'r', encoding='utf-8') as f:
+        file_info['text'] = f.read().strip()
     
     # Adicionar ao conteúdo do vídeo
-    videos_content[video_id].append(text)
-    
-    # Gerar áudio com Polly
-    print(f"Gerando áudio para {filename}...")
-    response = polly_client.synthesize_speech(
-        Text=text,
-        OutputFormat=OUTPUT_FORMAT,
-        VoiceId=VOICE_ID,
-        LanguageCode=LANGUAGE_CODE,
-        Engine=ENGINE
-    )
+    videos_content[file_info['video_id']].append(file_info['text'])
+
+# Gerar áudios em paralelo (cada bloco de texto é uma tarefa independente)
+print(f"=== Gerando áudios ({POLLY_WORKERS} threads, até {POLLY_MAX_TPS:g} requisições/s) ===")
+parts_dir = tempfile.mkdtemp(prefix='polly_parts_', dir=OUTPUT_FOLDER)
+executor = ThreadPoolExecutor(max_workers=POLLY_WORKERS)
+async_tasks = {}
+
+for file_info in files_data:
+    file_info['output_audio'] = os.path.join(OUTPUT_FOLDER, f"{Path(file_info['filename']).stem}.mp3")
+    file_info['cached_audio'] = cache_path_for(file_info['text'])
+    file_info['chunk_futures'] = []
+    
+    marks_cache = marks_cache_path_for(file_info['cached_audio'])
+    file_info['marks_futures'] = []
+    
+    # Com legendas ativas, o acerto exige também as speech marks em cache
+    if os.path.exists(file_info['cached_audio']) and (not SUBTITLES or os.path.exists(marks_cache)):
+        # Atualizar o horário de uso para a política LRU
+        os.utime(file_info['cached_audio'])
+        link_or_copy(file_info['cached_audio'], file_info['output_audio'])
+        if SUBTITLES:
+            os.utime(marks_cache)
+            with open(marks_cache, 'r', encoding='utf-8') as f:
+                file_info['marks'] = json.load(f)
+            file_info['duration_ms'] = section_duration_ms(file_info['cached_audio'], file_info['marks'])
+        cache_stats['hits'] += 1
+        print(f"[CACHE] Áudio reaproveitado: {file_info['output_audio']}")
+        continue
+    
+    is_async = use_async(file_info['text'])
+    chunks = split_text(file_info['text'], ASYNC_MAX_CHARS if is_async else MAX_CHARS)
+    mode = 'assíncrono' if is_async else 'síncrono'
+    print(f"Gerando áudio para {file_info['filename']} ({len(chunks)} bloco(s), modo {mode})...")
+    for index, chunk in enumerate(chunks):
+        part_file = os.path.join(parts_dir, f"{Path(file_info['filename']).stem}.{index:04d}")
+        file_info['chunk_futures'].append(submit_chunk(chunk, part_file, is_async))
+        if SUBTITLES:
+            file_info['marks_futures'].append(submit_chunk(chunk, f"{part_file}.marks", is_async, speech_marks=True))
+
+# Acompanhar as tarefas assíncronas em lote e baixar cada áudio assim que fica pronto
+if async_tasks:
+    print(f"\n=== Aguardando {len(async_tasks)} tarefas assíncronas ===")
+while async_tasks:
+    time.sleep(POLL_SECONDS)
+    try:
+        finished = poll_finished_tasks(polly_client, set(async_tasks))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ThrottlingException':
+            raise
+        finished = {}
     
-    # Salvar áudio
-    output_audio = os.path.join(OUTPUT_FOLDER, f"{Path(filename).stem}.mp3")
-    with open(output_audio, 'wb') as f:
-        f.write(response['AudioStream'].read())
+    for task_id, task in finished.items():
+        placeholder, part_file = async_tasks.pop(task_id)
+        if task['TaskStatus'] == 'completed':
+            download = executor.submit(download_task_audio, s3_client, task, part_file)
+            download.add_done_callback(lambda f, target=placeholder: forward_result(f, target))
+        else:
+            placeholder.set_exception(RuntimeError(task.get('TaskStatusReason', 'tarefa falhou')))
+    if async_tasks:
+        print(f"Tarefas pendentes: {len(async_tasks)}")
+
+# Montar as seções na mesma ordem dos arquivos
+failed = 0
+for file_info in files_data:
+    if not file_info['chunk_futures']:
+        continue
+    try:
+        assemble_section(file_info)
+    except Exception as e:
+        failed += 1
+        file_info['output_audio'] = None
+        print(f"[ERRO] Falha ao gerar áudio para {file_info['filename']}: {e}")
+
+executor.shutdown()
+shutil.rmtree(parts_dir, ignore_errors=True)
+
+# Gerar áudios compilados por vídeo a partir dos áudios das seções (sem nova síntese)
+if COMPILE_AUDIO:
+    print("\n=== Gerando compilações de áudio ===")
+    for video_id in sorted(videos_content.keys()):
+        section_audios = [f['output_audio'] for f in files_data if f['video_id'] == video_id]
+        if None in section_audios:
+            print(f"[AVISO] Vídeo {video_id:02d} com seções sem áudio, compilação ignorada")
+            continue
+        output_audio = os.path.join(OUTPUT_FOLDER, f"v{video_id:02d}_compiled.mp3")
+        concatenate_files(section_audios, output_audio)
+        print(f"[OK] Compilação salva: {output_audio}")
+
+# Gerar legendas por seção e por vídeo compilado (tempos acumulados entre as seções)
+if SUBTITLES:
+    print("\n=== Gerando legendas ===")
+    for file_info in files_data:
+        if file_info['output_audio']:
+            base_path = os.path.join(OUTPUT_FOLDER, Path(file_info['filename']).stem)
+            write_subtitles(file_info['marks'], file_info['duration_ms'], base_path)
+            print(f"[OK] Legendas salvas: {base_path}.srt / .vtt")
     
-    print(f"[OK] Áudio salvo: {output_audio}")
+    for video_id in sorted(videos_content.keys()):
+        sections = [f for f in files_data if f['video_id'] == video_id]
+        if any(f['output_audio'] is None for f in sections):
+            print(f"[AVISO] Vídeo {video_id:02d} com seções sem áudio, legenda compilada ignorada")
+            continue
+        compiled_marks = []
+        offset = 0
+        for section in sections:
+            compiled_marks.extend(dict(mark, time=mark['time'] + offset) for mark in section['marks'])
+            offset += section['duration_ms']
+        base_path = os.path.join(OUTPUT_FOLDER, f"v{video_id:02d}_compiled")
+        write_subtitles(compiled_marks, offset, base_path)
+        print(f"[OK] Legendas salvas: {base_path}.srt / .vtt")
 
 # Gerar arquivos de texto compilados por vídeo
 print("\n=== Gerando compilações de texto ===")
@@ -121,4 +645,10 @@ for video_id in sorted(videos_content.keys()):
     
     print(f"[OK] Compilação salva: {output_txt}")
 
+# Limitar tamanho do cache
+removed, cache_size = evict_cache()
+
 print("\n=== Processamento concluído ===")
+print(f"Áudios gerados: {len(files_data) - failed}/{len(files_data)}")
+print(f"Cache: {cache_stats['hits']} acertos, {cache_stats['misses']} sínteses novas")
+print(f"Tamanho do cache: {cache_size / (1024*1024):.2f} MB ({removed} áudios antigos removidos)")
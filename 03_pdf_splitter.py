@@ -1,9 +1,14 @@
 try:
     import os
     import re
+    import json
+    import hashlib
+    import gc
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor, Future
+    from functools import lru_cache
+    from bisect import bisect_left, bisect_right
     from pathlib import Path
-    from PyPDF2 import PdfReader
-    import pikepdf
     import fitz  # PyMuPDF
     from PIL import Image
     import io
@@ -31,6 +36,49 @@ MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', 100))
 MAX_DEPTH = int(os.getenv('PDF_MAX_DEPTH', 3))
 REMOVE_IMAGES = os.getenv('PDF_REMOVE_IMAGES', 'True').lower() == 'true'
 
+# Modo adaptativo: mantém as imagens e só as comprime (DPI e qualidade JPEG decrescentes) nos
+# segmentos que excedem o tamanho; remover imagens vira o último recurso (ignora PDF_REMOVE_IMAGES)
+ADAPTIVE_IMAGES = os.getenv('PDF_ADAPTIVE_IMAGES', 'False').lower() == 'true'
+IMAGE_STEPS = [(150, 75), (110, 60), (72, 45), (50, 30)]
+
+# Cópias dos PDFs de origem com imagens já substituídas, reaproveitadas entre execuções (limite de tamanho, LRU)
+CACHE_FOLDER = os.getenv('PDF_CACHE_FOLDER') or os.path.join(OUTPUT_FOLDER, 'pdf_cache')
+CACHE_MAX_MB = float(os.getenv('PDF_CACHE_MAX_MB', 2048))
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Texto extraído de cada segmento (arquivo .txt ao lado do PDF) para chamadas só com texto
+TEXT_SIDECARS = os.getenv('PDF_TEXT_SIDECARS', 'True').lower() == 'true'
+CHARS_PER_TOKEN = 4
+
+# Colunas da tabela de segmentos (gravadas mesmo quando nenhum segmento é gerado)
+SEGMENT_COLUMNS = ["original_pdf", "segment_name", "segment_path"] + (["text_path", "text_tokens"] if TEXT_SIDECARS else [])
+
+# Manifesto da última divisão de cada PDF (hash de origem, configurações e segmentos gerados)
+MANIFEST_FILE = os.getenv('PDF_MANIFEST_FILE') or os.path.join(OUTPUT_FOLDER, 'pdf_manifest.json')
+
+# Configurações que alteram o resultado da divisão (mudanças forçam nova divisão)
+SPLIT_SETTINGS = {
+    'max_file_size_mb': MAX_FILE_SIZE_MB,
+    'max_pages': MAX_PAGES,
+    'max_depth': MAX_DEPTH,
+    'remove_images': REMOVE_IMAGES,
+    'adaptive_images': ADAPTIVE_IMAGES,
+    'text_sidecars': TEXT_SIDECARS
+}
+
+# Processos usados para dividir capítulos em paralelo (sobrescrito por --workers)
+WORKERS = int(os.getenv('PDF_WORKERS', 1))
+
+# Modo de baixa memória: libera os objetos de cada segmento logo após gravá-lo
+LOW_MEMORY = os.getenv('PDF_LOW_MEMORY', 'False').lower() == 'true'
+# Teto de memória residente por processo em MB (0 = sem limite)
+MAX_RSS_MB = float(os.getenv('PDF_MAX_RSS_MB', 0))
+# Crescimento de RSS (MB) que faz o modo de baixa memória esvaziar o cache de objetos do MuPDF
+LOW_MEMORY_GROWTH_MB = 32
+
+# Custo fixo estimado por página (dicionário da página, xref, estrutura) no empacotamento por tamanho
+PAGE_OVERHEAD_BYTES = 1024
+
 # Validar MAX_DEPTH
 if MAX_DEPTH is None:
     MAX_DEPTH = 3
@@ -38,124 +86,529 @@ if MAX_DEPTH is None:
 # Criar pasta de output
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
-def get_sections_at_level(outline, level, reader):
-    """Extrai seções de um nível específico do outline"""
-    sections = []
-    
-    def traverse(items, current_level=0):
-        for item in items:
-            if isinstance(item, list):
-                traverse(item, current_level + 1)
-            else:
-                if current_level == level:
-                    page_num = reader.get_destination_page_number(item)
-                    sections.append((item.title, page_num))
-    
-    traverse(outline)
-    return sections
-
-def compress_pdf_images(input_file):
-    """Substitui imagens do PDF por quadrados pretos para reduzir tamanho"""
-    if not REMOVE_IMAGES:
-        return
-    
-    doc = fitz.open(input_file)
-    
-    # Verificar se o PDF tem páginas
-    if doc.page_count == 0:
-        doc.close()
-        return
-    
-    # Processar cada página
-    for page_num in range(doc.page_count):
-        page = doc[page_num]
-        image_list = page.get_images()
+def build_outline_index(doc):
+    """Percorre o outline uma única vez e monta o índice de seções
+    
+    Retorna um dicionário com:
+    - tree: árvore de bookmarks ({title, page, level, children}) com páginas já resolvidas
+    - levels: por nível, arrays 'pages' e 'titles' ordenados por página (para busca binária)
+    """
+    tree = []
+    nodes_by_level = {}
+    
+    # get_toc devolve [nível (1 = capítulo), título, página (1 = primeira)] em ordem de documento
+    ancestors = []
+    for toc_level, title, page in doc.get_toc(simple=True):
+        current_level = toc_level - 1
+        node = {
+            'title': title,
+            'page': page - 1 if page > 0 else None,
+            'level': current_level,
+            'children': []
+        }
         
-        for img_index, img in enumerate(image_list):
-            xref = img[0]
+        # O pai é o último bookmark de nível inferior
+        del ancestors[current_level:]
+        siblings = ancestors[-1]['children'] if ancestors else tree
+        siblings.append(node)
+        ancestors.append(node)
+        nodes_by_level.setdefault(current_level, []).append(node)
+    
+    levels = {}
+    for level, nodes in nodes_by_level.items():
+        nodes = sorted((n for n in nodes if n['page'] is not None), key=lambda n: n['page'])
+        levels[level] = {
+            'pages': [n['page'] for n in nodes],
+            'titles': [n['title'] for n in nodes]
+        }
+    
+    return {'page_count': doc.page_count, 'tree': tree, 'levels': levels}
+
+def get_sections_in_range(outline_index, level, start_page, end_page):
+    """Seções (título, página) de um nível que começam em [start_page, end_page)"""
+    level_index = outline_index['levels'].get(level)
+    if not level_index:
+        return []
+    
+    pages = level_index['pages']
+    first = bisect_left(pages, start_page)
+    last = bisect_left(pages, end_page)
+    return list(zip(level_index['titles'][first:last], pages[first:last]))
+
+def save_outline_index(outline_index, output_dir):
+    """Salva o índice do outline em JSON para reuso por outras ferramentas"""
+    index_path = os.path.join(output_dir, "outline_index.json")
+    with open(index_path, 'w', encoding='utf-8') as f:
+        json.dump(outline_index, f, ensure_ascii=False, indent=2)
+    return index_path
+
+@lru_cache(maxsize=None)
+def black_jpeg(width, height):
+    """JPEG preto comprimido de um tamanho (gerado uma única vez por dimensão)"""
+    black_image = Image.new('RGB', (width, height), color='black')
+    output_buffer = io.BytesIO()
+    black_image.save(output_buffer, format='JPEG', quality=10)
+    return output_buffer.getvalue()
+
+def downsample_image(doc, page, xref, dpi, quality):
+    """Reamostra uma imagem para no máximo dpi (pelo tamanho em que aparece na página) e a
+    recodifica em JPEG; retorna os novos bytes ou None se não houver ganho"""
+    rects = page.get_image_rects(xref)
+    if not rects:
+        return None
+    
+    pixmap = fitz.Pixmap(doc, xref)
+    if pixmap.alpha:
+        pixmap = fitz.Pixmap(pixmap, 0)
+    if pixmap.colorspace and pixmap.colorspace.n not in (1, 3):
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+    mode = 'L' if pixmap.n == 1 else 'RGB'
+    image = Image.frombytes(mode, (pixmap.width, pixmap.height), pixmap.samples)
+    
+    # DPI efetivo: pixels da imagem sobre a maior largura em que ela é exibida (72 pontos por polegada)
+    displayed_inches = max(rect.width for rect in rects) / 72
+    effective_dpi = pixmap.width / displayed_inches if displayed_inches else dpi
+    if effective_dpi > dpi:
+        scale = dpi / effective_dpi
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+    
+    output_buffer = io.BytesIO()
+    image.save(output_buffer, format='JPEG', quality=quality, optimize=True)
+    image_bytes = output_buffer.getvalue()
+    
+    if len(image_bytes) >= len(doc.xref_stream_raw(xref) or b''):
+        return None
+    return image_bytes
+
+def compress_pdf_images(doc, dpi=None, quality=None):
+    """Reduz o tamanho das imagens do PDF
+    
+    Sem dpi, substitui as imagens por quadrados pretos; com dpi e quality, reamostra e recodifica
+    cada imagem em JPEG, mantendo a original quando a nova versão não for menor.
+    """
+    # Cada imagem é substituída uma única vez, mesmo se usada em várias páginas
+    processed_xrefs = set()
+    for page in doc:
+        for img in page.get_images():
+            xref, smask, width, height = img[0], img[1], img[2] or 100, img[3] or 100
+            if xref in processed_xrefs:
+                continue
+            processed_xrefs.add(xref)
             
             try:
-                # Extrair informações da imagem
-                base_image = doc.extract_image(xref)
-                width = base_image.get("width", 100)
-                height = base_image.get("height", 100)
-                
-                # Criar imagem preta do mesmo tamanho
-                black_image = Image.new('RGB', (width, height), color='black')
-                
-                # Salvar como JPEG comprimido
-                output_buffer = io.BytesIO()
-                black_image.save(output_buffer, format='JPEG', quality=10)
-                black_bytes = output_buffer.getvalue()
-                
-                # Substituir imagem no PDF
-                doc.update_stream(xref, black_bytes)
+                if dpi is None:
+                    doc.update_stream(xref, black_jpeg(width, height))
+                elif not smask:
+                    # Imagens com transparência (máscara) são mantidas
+                    image_bytes = downsample_image(doc, page, xref, dpi, quality)
+                    if image_bytes:
+                        page.replace_image(xref, stream=image_bytes)
             except Exception:
                 # Se falhar, manter imagem original
                 continue
-    
-    temp_file = input_file + ".tmp"
-    doc.save(temp_file, garbage=4, deflate=True, clean=True)
-    doc.close()
-    
-    os.replace(temp_file, input_file)
 
-def split_section(pdf, reader, start_page, end_page, output_dir, base_name, prefix, level, csv_data, original_pdf_name):
-    """Divide uma seção recursivamente se necessário"""
+def build_image_ladder(source_hash):
+    """Versões do PDF com imagens cada vez mais comprimidas, da mais leve à remoção (modo adaptativo)
+    
+    As versões são geradas sob demanda e guardadas no cache pelo hash do PDF de origem.
+    """
+    ladder = [
+        {
+            'path': os.path.join(CACHE_FOLDER, f"{source_hash}.{dpi}dpi-q{quality}.pdf"),
+            'dpi': dpi,
+            'quality': quality,
+            'label': f"imagens em {dpi} dpi, qualidade {quality}"
+        }
+        for dpi, quality in IMAGE_STEPS
+    ]
+    ladder.append({
+        'path': os.path.join(CACHE_FOLDER, f"{source_hash}.pdf"),
+        'dpi': None,
+        'quality': None,
+        'label': "imagens removidas"
+    })
+    return ladder
+
+# Versões com imagens comprimidas disponíveis para cada documento de origem (modo adaptativo)
+image_ladders = {}
+
+def get_variant_document(rung, source_doc):
+    """Abre uma versão da escada de imagens, gerando-a a partir do documento de origem se necessário"""
+    if not os.path.exists(rung['path']):
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        variant_doc = fitz.open(source_doc.name)
+        compress_pdf_images(variant_doc, rung['dpi'], rung['quality'])
+        
+        # Nome temporário por processo: workers podem gerar a mesma versão ao mesmo tempo
+        temp_file = f"{rung['path']}.{os.getpid()}.tmp"
+        variant_doc.save(temp_file, garbage=4, deflate=True, clean=True)
+        variant_doc.close()
+        os.replace(temp_file, rung['path'])
+    else:
+        os.utime(rung['path'])
+    return get_document(rung['path'])
+
+def file_sha256(file_path):
+    """Calcula o SHA-256 do arquivo em blocos"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest():
+    """Carrega o manifesto da última divisão"""
+    if os.path.exists(MANIFEST_FILE):
+        try:
+            with open(MANIFEST_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            data.setdefault('files', {})
+            return data
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"[AVISO] Manifesto {MANIFEST_FILE} inválido, ignorando: {e}")
+    return {'files': {}}
+
+def save_manifest(manifest):
+    """Salva o manifesto de forma atômica (arquivo temporário + rename)"""
+    temp_file = MANIFEST_FILE + ".tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, MANIFEST_FILE)
+
+def is_unchanged(entry, source_hash):
+    """Verifica se a divisão registrada no manifesto continua válida
+    
+    Exige o mesmo PDF de origem, as mesmas configurações e todos os segmentos intactos.
+    """
+    if not entry or entry['sha256'] != source_hash or entry['settings'] != SPLIT_SETTINGS:
+        return False
+    if not all(os.path.exists(row['text_path']) for row in entry['rows'] if row.get('text_path')):
+        return False
+    return all(
+        os.path.exists(segment_path) and file_sha256(segment_path) == segment_hash
+        for segment_path, segment_hash in entry['segments'].items()
+    )
+
+def load_previous_rows(csv_path):
+    """Linhas da tabela de segmentos anterior por PDF (com colunas adicionadas depois, como summary_path)"""
+    if not os.path.exists(csv_path):
+        return {}
+    
+    previous_rows = {}
+    try:
+        previous_df = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    except pd.errors.EmptyDataError:
+        return {}
+    except (pd.errors.ParserError, OSError) as e:
+        print(f"[AVISO] Tabela {csv_path} inválida, ignorando: {e}")
+        return {}
+    if 'original_pdf' not in previous_df.columns:
+        return {}
+    
+    for row in previous_df.to_dict('records'):
+        previous_rows.setdefault(row['original_pdf'], []).append(row)
+    return previous_rows
+
+def evict_cache(source_hashes):
+    """Limpa o cache de PDFs: remove as cópias de PDFs que saíram da pasta de entrada (ou foram alterados)
+    e, depois, as usadas há mais tempo até o cache caber em PDF_CACHE_MAX_MB
+    """
+    if not os.path.isdir(CACHE_FOLDER):
+        return 0, 0
+    
+    entries = []
+    removed = 0
+    for name in os.listdir(CACHE_FOLDER):
+        path = os.path.join(CACHE_FOLDER, name)
+        if name.split('.')[0] not in source_hashes:
+            os.remove(path)
+            removed += 1
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total_size = sum(size for _, size, _ in entries)
+    max_size = CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(path)
+        total_size -= size
+        removed += 1
+    return removed, total_size
+
+def open_source(pdf_path, source_hash):
+    """Abre o PDF a ser dividido: a cópia sem imagens (em cache pelo hash) ou o original
+    
+    Retorna o documento aberto e o caminho do arquivo com o mesmo conteúdo (usado pelos workers)
+    """
+    if not REMOVE_IMAGES or ADAPTIVE_IMAGES:
+        return fitz.open(pdf_path), pdf_path
+    
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    cached_file = os.path.join(CACHE_FOLDER, f"{source_hash}.pdf")
+    if os.path.exists(cached_file):
+        print("[CACHE] Cópia sem imagens reaproveitada")
+        os.utime(cached_file)
+        return fitz.open(cached_file), cached_file
+    
+    # Substituir as imagens no próprio documento aberto, que segue sendo usado na divisão
+    doc = fitz.open(pdf_path)
+    compress_pdf_images(doc)
+    
+    temp_file = cached_file + ".tmp"
+    doc.save(temp_file, garbage=4, deflate=True, clean=True)
+    os.replace(temp_file, cached_file)
     
-    # Criar PDF temporário para verificar tamanho
-    temp_pdf = pikepdf.new()
-    temp_pdf.pages.extend(pdf.pages[start_page:end_page])
+    print(f"Cópia sem imagens: {os.path.getsize(cached_file) / (1024*1024):.2f} MB")
     
-    num_pages = end_page - start_page
-    temp_file = os.path.join(output_dir, f"temp_{prefix}.pdf")
-    temp_pdf.remove_unreferenced_resources()
-    temp_pdf.save(temp_file)
-    temp_pdf.close()
+    # Em baixa memória, descartar o documento carregado e reabrir a cópia (leitura sob demanda)
+    if LOW_MEMORY:
+        doc.close()
+        release_memory()
+        doc = fitz.open(cached_file)
+    return doc, cached_file
+
+def current_rss_mb():
+    """Memória residente (RSS) atual do processo em MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024*1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    
+    # Fora do Linux: pico do processo informado pelo sistema
+    try:
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss / (1024*1024) if os.uname().sysname == 'Darwin' else max_rss / 1024
+    except ImportError:
+        return 0.0
+
+# Pico de memória observado desde o último reset (por PDF ou por tarefa)
+memory_stats = {'peak_mb': 0.0, 'released_mb': 0.0}
+
+def sample_memory():
+    """Atualiza o pico de memória com a leitura atual"""
+    rss = current_rss_mb()
+    memory_stats['peak_mb'] = max(memory_stats['peak_mb'], rss)
+    return rss
+
+def release_memory():
+    """Libera objetos já gravados e aplica o teto de memória (PDF_MAX_RSS_MB)"""
+    rss = sample_memory()
+    over_limit = MAX_RSS_MB and rss > MAX_RSS_MB
+    if not LOW_MEMORY and not over_limit:
+        return
     
-    # Remover imagens antes de calcular tamanho
-    compress_pdf_images(temp_file)
+    # Os objetos do segmento já foram liberados ao fechar o documento; quando a memória cresce
+    # demais, coletar ciclos do Python e esvaziar o cache de objetos do MuPDF
+    if over_limit or rss - memory_stats['released_mb'] > LOW_MEMORY_GROWTH_MB:
+        gc.collect()
+        fitz.TOOLS.store_shrink(100)
+        rss = memory_stats['released_mb'] = current_rss_mb()
     
-    file_size_mb = os.path.getsize(temp_file) / (1024*1024)
+    if MAX_RSS_MB and rss > MAX_RSS_MB:
+        raise MemoryError(f"memória residente de {rss:.0f} MB acima do limite PDF_MAX_RSS_MB={MAX_RSS_MB:.0f}")
+
+def build_segment(doc, start_page, end_page):
+    """Monta o segmento em memória e retorna seus bytes"""
+    segment_doc = fitz.open()
+    segment_doc.insert_pdf(doc, from_page=start_page, to_page=end_page - 1)
+    segment_bytes = segment_doc.tobytes(garbage=3, deflate=True, use_objstms=1)
+    sample_memory()
+    segment_doc.close()
+    
+    return segment_bytes
+
+def extract_text(doc, start_page, end_page):
+    """Texto das páginas [start_page, end_page) em formato compacto (espaços e linhas em branco reduzidos)"""
+    text = "\n".join(doc[page_num].get_text() for page_num in range(start_page, end_page))
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r' ?\n ?', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+def save_segment(doc, start_page, end_page, segment_bytes, output_dir, base_name, prefix, csv_data, original_pdf_name):
+    """Grava um segmento aceito no disco (e seu texto, se habilitado) e registra no DataFrame"""
+    final_file = os.path.join(output_dir, f"{prefix}_{base_name}.pdf")
+    with open(final_file, 'wb') as f:
+        f.write(segment_bytes)
     
-    # Verificar se respeita os limites
-    exceeds_size = MAX_FILE_SIZE_MB and file_size_mb > MAX_FILE_SIZE_MB
+    # Adicionar ao DataFrame
+    segment_name = f"{prefix}_{base_name}"
+    relative_path = os.path.relpath(final_file, '.')
+    row = {
+        "original_pdf": original_pdf_name,
+        "segment_name": segment_name,
+        "segment_path": relative_path
+    }
+    
+    # Texto do segmento extraído das mesmas páginas, com estimativa de tokens
+    if TEXT_SIDECARS:
+        text = extract_text(doc, start_page, end_page)
+        text_file = os.path.join(output_dir, f"{prefix}_{base_name}.txt")
+        with open(text_file, 'w', encoding='utf-8') as f:
+            f.write(text)
+        row["text_path"] = os.path.relpath(text_file, '.')
+        row["text_tokens"] = -(-len(text) // CHARS_PER_TOKEN)
+    
+    csv_data.append(row)
+    release_memory()
+    return final_file
+
+def fits_size(segment_bytes):
+    """Verifica se um segmento respeita PDF_MAX_FILE_SIZE_MB"""
+    return not (MAX_FILE_SIZE_MB and len(segment_bytes) / (1024*1024) > MAX_FILE_SIZE_MB)
+
+def fits_limits(segment_bytes, num_pages):
+    """Verifica se um segmento respeita PDF_MAX_FILE_SIZE_MB e PDF_MAX_PAGES"""
     exceeds_pages = MAX_PAGES and num_pages > MAX_PAGES
-    
-    if not exceeds_size and not exceeds_pages:
-        # Renomear arquivo temporário para final (já com imagens removidas)
-        final_file = os.path.join(output_dir, f"{prefix}_{base_name}.pdf")
-        os.rename(temp_file, final_file)
+    return fits_size(segment_bytes) and not exceeds_pages
+
+def build_shaped_segment(doc, start_page, end_page):
+    """Monta o segmento; no modo adaptativo, se ele exceder só o tamanho, tenta as versões com
+    imagens cada vez mais comprimidas até caber
+    
+    Retorna (bytes, descrição das imagens usadas ou None para as originais)
+    """
+    segment_bytes = build_segment(doc, start_page, end_page)
+    ladder = image_ladders.get(doc.name)
+    if not ladder or fits_size(segment_bytes) or (MAX_PAGES and end_page - start_page > MAX_PAGES):
+        return segment_bytes, None
+    
+    for rung in ladder:
+        segment_bytes = build_segment(get_variant_document(rung, doc), start_page, end_page)
+        if fits_size(segment_bytes):
+            break
+    return segment_bytes, rung['label']
+
+def describe_images(image_label):
+    """Sufixo das mensagens de segmento quando as imagens foram comprimidas"""
+    return f" [{image_label}]" if image_label else ""
+
+# Somas acumuladas dos tamanhos estimados por página, por documento
+page_size_sums = {}
+
+def estimate_page_sizes(doc):
+    """Somas acumuladas do tamanho estimado de cada página
+    
+    Cada página conta seus streams de conteúdo e imagens (já comprimidos) mais um custo fixo;
+    recursos compartilhados entre páginas contam apenas na primeira vez em que aparecem.
+    """
+    if doc.name in page_size_sums:
+        return page_size_sums[doc.name]
+    
+    seen_xrefs = set()
+    sums = [0]
+    for page in doc:
+        page_size = PAGE_OVERHEAD_BYTES
+        for xref in page.get_contents() + [img[0] for img in page.get_images()]:
+            if xref not in seen_xrefs:
+                seen_xrefs.add(xref)
+                page_size += len(doc.xref_stream_raw(xref) or b'')
+        sums.append(sums[-1] + page_size)
+    
+    page_size_sums[doc.name] = sums
+    return sums
+
+def largest_fitting_range(doc, start_page, end_page):
+    """Maior intervalo [start_page, fim) que respeita os limites, por busca binária no fim
+    
+    A estimativa por página define o primeiro palpite; cada palpite é confirmado montando o
+    segmento em memória. Retorna (fim, bytes, imagens); se nem uma página couber, retorna a página sozinha.
+    """
+    sums = estimate_page_sizes(doc)
+    low = start_page + 1
+    high = min(end_page, start_page + MAX_PAGES) if MAX_PAGES else end_page
+    
+    # Palpite: maior fim cuja soma estimada cabe no limite de tamanho
+    if MAX_FILE_SIZE_MB:
+        budget = sums[start_page] + MAX_FILE_SIZE_MB * 1024 * 1024
+        probe = bisect_right(sums, budget, low, high + 1) - 1
+    else:
+        probe = high
+    probe = min(max(probe, low), high)
+    
+    best = None
+    first_probe = True
+    while low <= high:
+        segment_bytes, image_label = build_shaped_segment(doc, start_page, probe)
+        if fits_limits(segment_bytes, probe - start_page):
+            best = (probe, segment_bytes, image_label)
+            low = probe + 1
+            # Com um palpite certo, basta confirmar que a página seguinte já não cabe
+            probe = low if first_probe else (low + high) // 2
+        else:
+            high = probe - 1
+            probe = high if first_probe else (low + high) // 2
+        first_probe = False
+    
+    if best is None:
+        best = (start_page + 1, *build_shaped_segment(doc, start_page, start_page + 1))
+    return best
+
+def pack_pages(doc, start_page, end_page, output_dir, base_name, prefix, csv_data, original_pdf_name):
+    """Divide [start_page, end_page) no menor número de intervalos consecutivos dentro dos limites
+    
+    Cada segmento é o maior intervalo que cabe a partir do fim do anterior (guloso, o que
+    minimiza o número de segmentos). Os segmentos recebem prefixos prefix.01, prefix.02, ...
+    (ou 01, 02, ... sem prefixo).
+    """
+    generated_files = []
+    current_page = start_page
+    while current_page < end_page:
+        range_end, segment_bytes, image_label = largest_fitting_range(doc, current_page, end_page)
+        num_pages = range_end - current_page
+        file_size_mb = len(segment_bytes) / (1024*1024)
         
-        # Adicionar ao DataFrame
-        segment_name = f"{prefix}_{base_name}"
-        relative_path = os.path.relpath(final_file, '.')
-        csv_data.append({
-            "original_pdf": original_pdf_name,
-            "segment_name": segment_name,
-            "segment_path": relative_path
-        })
+        number = len(generated_files) + 1
+        segment_prefix = f"{prefix}.{number:02d}" if prefix else f"{number:02d}"
+        final_file = save_segment(doc, current_page, range_end, segment_bytes,
+                                  output_dir, base_name, segment_prefix, csv_data, original_pdf_name)
         
-        # Recalcular tamanho após compressão
-        file_size_mb = os.path.getsize(final_file) / (1024*1024)
-        print(f"[OK] {prefix}: {num_pages} páginas ({file_size_mb:.2f} MB)")
-        return [final_file]
+        if fits_limits(segment_bytes, num_pages):
+            print(f"[OK] {segment_prefix}: {num_pages} páginas ({file_size_mb:.2f} MB){describe_images(image_label)}")
+        else:
+            print(f"[OK] {segment_prefix}: {num_pages} páginas ({file_size_mb:.2f} MB) [LIMITE EXCEDIDO]{describe_images(image_label)}")
+        
+        generated_files.append(final_file)
+        current_page = range_end
+    return generated_files
+
+def split_section(doc, outline_index, start_page, end_page, output_dir, base_name, prefix, level, csv_data, original_pdf_name):
+    """Divide uma seção recursivamente se necessário"""
+    
+    # Bookmarks na mesma página geram seções vazias (o PyMuPDF não salva PDFs sem páginas)
+    if end_page <= start_page:
+        print(f"[AVISO] {prefix}: seção sem páginas (bookmarks na mesma página), ignorada")
+        return []
+    
+    # Montar o segmento em memória para verificar o tamanho (nada é gravado em disco)
+    segment_bytes, image_label = build_shaped_segment(doc, start_page, end_page)
     
-    # Remove arquivo temporário
-    os.remove(temp_file)
+    num_pages = end_page - start_page
+    file_size_mb = len(segment_bytes) / (1024*1024)
+    
+    # Verificar se respeita os limites
+    if fits_limits(segment_bytes, num_pages):
+        final_file = save_segment(doc, start_page, end_page, segment_bytes,
+                                  output_dir, base_name, prefix, csv_data, original_pdf_name)
+        print(f"[OK] {prefix}: {num_pages} páginas ({file_size_mb:.2f} MB){describe_images(image_label)}")
+        return [final_file]
     
     # Se excede limites e ainda pode ir mais fundo
     if level < MAX_DEPTH:
         print(f"[AVISO] {prefix} excede limites ({num_pages} páginas, {file_size_mb:.2f} MB) - dividindo em subnível {level+1}")
         
         # Buscar subseções no próximo nível
-        subsections = get_sections_at_level(reader.outline, level, reader)
-        
-        # Filtrar apenas subseções dentro do intervalo atual
-        relevant_subsections = [(title, page) for title, page in subsections 
-                                if start_page <= page < end_page]
+        relevant_subsections = get_sections_in_range(outline_index, level, start_page, end_page)
         
         if len(relevant_subsections) > 1:
+            # Liberar os bytes da seção antes de montar as subseções
+            del segment_bytes
+            
             # Adicionar marcador final
             relevant_subsections.append(("END", end_page))
             
@@ -164,113 +617,268 @@ def split_section(pdf, reader, start_page, end_page, output_dir, base_name, pref
                 sub_end = relevant_subsections[i + 1][1]
                 sub_prefix = f"{prefix}.{i+1:02d}"
                 
-                files = split_section(pdf, reader, sub_start, sub_end, 
+                files = split_section(doc, outline_index, sub_start, sub_end, 
                                      output_dir, base_name, sub_prefix, level + 1, csv_data, original_pdf_name)
                 generated_files.extend(files)
             
             return generated_files
     
-    # Se não pode dividir mais ou não há subseções, salva mesmo excedendo
-    final_file = os.path.join(output_dir, f"{prefix}_{base_name}.pdf")
-    final_pdf = pikepdf.new()
-    final_pdf.pages.extend(pdf.pages[start_page:end_page])
-    final_pdf.remove_unreferenced_resources()
-    final_pdf.save(final_file)
-    final_pdf.close()
-    
-    # Comprimir imagens
-    compress_pdf_images(final_file)
-    
-    # Adicionar ao DataFrame
-    segment_name = f"{prefix}_{base_name}"
-    relative_path = os.path.relpath(final_file, '.')
-    csv_data.append({
-        "original_pdf": original_pdf_name,
-        "segment_name": segment_name,
-        "segment_path": relative_path
-    })
+    # Uma única página não pode ser dividida: salva mesmo excedendo
+    if num_pages == 1:
+        final_file = save_segment(doc, start_page, end_page, segment_bytes,
+                                  output_dir, base_name, prefix, csv_data, original_pdf_name)
+        print(f"[OK] {prefix}: {num_pages} páginas ({file_size_mb:.2f} MB) [LIMITE EXCEDIDO]{describe_images(image_label)}")
+        return [final_file]
     
-    # Recalcular tamanho após compressão
-    file_size_mb = os.path.getsize(final_file) / (1024*1024)
-    print(f"[OK] {prefix}: {num_pages} páginas ({file_size_mb:.2f} MB) [LIMITE EXCEDIDO]")
-    return [final_file]
+    # Sem subseções para descer: empacotar as páginas por tamanho
+    del segment_bytes
+    print(f"[AVISO] {prefix} sem subseções - dividindo por páginas")
+    return pack_pages(doc, start_page, end_page, output_dir, base_name, prefix, csv_data, original_pdf_name)
+
+# Documentos abertos neste processo, por caminho (cada worker abre os seus uma única vez)
+open_documents = {}
+
+def get_document(source_path):
+    """Documento aberto neste processo para o caminho (aberto na primeira vez)"""
+    doc = open_documents.get(source_path)
+    if doc is None:
+        doc = open_documents[source_path] = fitz.open(source_path)
+    return doc
 
-# Coletar arquivos PDF
-pdf_files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith('.pdf')]
+def close_documents(paths):
+    """Fecha os documentos abertos para os caminhos informados"""
+    for path in paths:
+        doc = open_documents.pop(path, None)
+        if doc is not None:
+            page_size_sums.pop(doc.name, None)
+            doc.close()
 
-print(f"Encontrados {len(pdf_files)} arquivos PDF para processar\n")
+def prepare_task(source_path, image_ladder):
+    """Prepara o processo para uma tarefa: registra a escada de imagens e, em baixa memória,
+    fecha os documentos de outros PDFs"""
+    memory_stats['peak_mb'] = current_rss_mb()
+    ladder_paths = [rung['path'] for rung in image_ladder or []]
+    if LOW_MEMORY:
+        close_documents([path for path in open_documents if path != source_path and path not in ladder_paths])
+        release_memory()
+    if image_ladder:
+        image_ladders[source_path] = image_ladder
+    return get_document(source_path)
 
-# Preparar lista para DataFrame
-csv_data = []
+def split_chapter(source_path, image_ladder, outline_index, start_page, end_page, output_dir, base_name, prefix, original_pdf_name):
+    """Divide um capítulo; executado no processo principal ou em um worker
+    
+    Retorna as linhas do CSV, os arquivos gerados (na ordem dos segmentos) e o pico de memória em MB
+    """
+    doc = prepare_task(source_path, image_ladder)
+    csv_rows = []
+    files = split_section(doc, outline_index, start_page, end_page,
+                          output_dir, base_name, prefix, 1, csv_rows, original_pdf_name)
+    return csv_rows, files, memory_stats['peak_mb']
 
-# Processar cada PDF
-for pdf_filename in sorted(pdf_files):
-    pdf_path = os.path.join(INPUT_FOLDER, pdf_filename)
-    base_name = Path(pdf_filename).stem
+def pack_document(source_path, image_ladder, output_dir, base_name, original_pdf_name):
+    """Divide um PDF sem bookmarks apenas por tamanho; executado no processo principal ou em um worker"""
+    doc = prepare_task(source_path, image_ladder)
+    csv_rows = []
+    files = pack_pages(doc, 0, doc.page_count, output_dir, base_name, None, csv_rows, original_pdf_name)
+    return csv_rows, files, memory_stats['peak_mb']
+
+def run_task(executor, function, *args):
+    """Executa a tarefa no pool (se houver) ou no próprio processo; retorna um future em ambos os casos"""
+    if executor:
+        return executor.submit(function, *args)
+    
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except MemoryError as e:
+        future.set_exception(e)
+    return future
+
+def main():
+    parser = argparse.ArgumentParser(description="Divide PDFs em segmentos por capítulos")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="Processos para dividir capítulos em paralelo (padrão: PDF_WORKERS ou 1)")
+    args = parser.parse_args()
     
-    # Limpar nome do arquivo para criar pasta
-    folder_name = re.sub(r'\s+', '-', base_name)
-    folder_name = re.sub(r'-+', '-', folder_name).strip('-')
+    # Coletar arquivos PDF
+    pdf_files = [f for f in os.listdir(INPUT_FOLDER) if f.lower().endswith('.pdf')]
     
-    # Criar pasta específica para este PDF (limpar se já existir)
-    output_dir = os.path.join(OUTPUT_FOLDER, folder_name)
-    if os.path.exists(output_dir):
-        for file in os.listdir(output_dir):
-            os.remove(os.path.join(output_dir, file))
-    else:
-        os.makedirs(output_dir)
+    print(f"Encontrados {len(pdf_files)} arquivos PDF para processar\n")
+    
+    # Preparar lista para DataFrame
+    csv_data = []
+    csv_path = os.path.join(DATA_FOLDER, TABLE_NAME)
     
-    print(f"Processando {pdf_filename}...")
+    # PDFs sem alterações desde a última execução mantêm seus segmentos e linhas da tabela
+    manifest = load_manifest()
+    previous_rows = load_previous_rows(csv_path)
+    source_hashes = {}
     
-    # Tamanho do arquivo original
-    original_size = os.path.getsize(pdf_path)
-    print(f"Tamanho original: {original_size / (1024*1024):.2f} MB")
+    # Com mais de um worker, os capítulos são enviados a um pool de processos
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    if executor:
+        print(f"Dividindo capítulos com {args.workers} processos\n")
     
-    # Ler bookmarks com PyPDF2
-    reader = PdfReader(pdf_path)
+    # Tarefas por PDF, na ordem de processamento (define a ordem das linhas do CSV)
+    pdf_tasks = []
     
-    # Verificar se há bookmarks (capítulos)
-    if not reader.outline:
-        print(f"Sem bookmarks encontrados. Use o arquivo original.\n")
-        continue
+    # Pico de memória do processo principal ao preparar cada PDF
+    prepare_peaks = {}
     
-    # Extrair bookmarks de nível 0 (capítulos principais)
-    sections = get_sections_at_level(reader.outline, 0, reader)
+    # Processar cada PDF
+    for pdf_filename in sorted(pdf_files):
+        pdf_path = os.path.join(INPUT_FOLDER, pdf_filename)
+        base_name = Path(pdf_filename).stem
+        
+        # Limpar nome do arquivo para criar pasta
+        folder_name = re.sub(r'\s+', '-', base_name)
+        folder_name = re.sub(r'-+', '-', folder_name).strip('-')
+        
+        source_hash = source_hashes[pdf_filename] = file_sha256(pdf_path)
+        entry = manifest['files'].get(pdf_filename)
+        if is_unchanged(entry, source_hash):
+            # Preferir as linhas atuais da tabela (preservam summary_path do 04)
+            rows = previous_rows.get(pdf_filename)
+            if not rows or [row['segment_path'] for row in rows] != list(entry['segments']):
+                rows = entry['rows']
+            print(f"[CACHE] {pdf_filename} sem alterações, {len(rows)} segmentos mantidos\n")
+            pdf_tasks.append((pdf_filename, None, rows))
+            continue
+        
+        # Criar pasta específica para este PDF (limpar se já existir)
+        output_dir = os.path.join(OUTPUT_FOLDER, folder_name)
+        if os.path.exists(output_dir):
+            for file in os.listdir(output_dir):
+                os.remove(os.path.join(output_dir, file))
+        else:
+            os.makedirs(output_dir)
+        
+        print(f"Processando {pdf_filename}...")
+        
+        # Tamanho do arquivo original
+        original_size = os.path.getsize(pdf_path)
+        print(f"Tamanho original: {original_size / (1024*1024):.2f} MB")
+        
+        # Abrir o PDF uma única vez (imagens substituídas antes de qualquer divisão)
+        memory_stats['peak_mb'] = current_rss_mb()
+        try:
+            doc, source_path = open_source(pdf_path, source_hash)
+            image_ladder = build_image_ladder(source_hash) if ADAPTIVE_IMAGES else None
+        except MemoryError as e:
+            # Falha ao preparar o PDF: tratada como uma tarefa com erro (fica fora da tabela e do manifesto)
+            failed_task = Future()
+            failed_task.set_exception(e)
+            pdf_tasks.append((pdf_filename, [failed_task], None))
+            prepare_peaks[pdf_filename] = sample_memory()
+            print()
+            continue
+        page_count = doc.page_count
+        
+        # Montar o índice do outline uma única vez (reutilizado em todas as subdivisões)
+        sections = []
+        if doc.get_toc():
+            outline_index = build_outline_index(doc)
+            save_outline_index(outline_index, output_dir)
+            
+            # Extrair bookmarks de nível 0 (capítulos principais)
+            sections = get_sections_in_range(outline_index, 0, 0, page_count)
+            if not sections:
+                print(f"Sem capítulos válidos encontrados. Dividindo por tamanho.")
+        else:
+            print(f"Sem bookmarks encontrados. Dividindo por tamanho.")
+        
+        chapter_tasks = []
+        if executor:
+            # Os workers abrem o arquivo por conta própria
+            doc.close()
+        else:
+            open_documents[source_path] = doc
+        
+        # Sem capítulos: empacotar as páginas pelo tamanho estimado
+        if not sections:
+            task_args = (source_path, image_ladder, output_dir, folder_name, pdf_filename)
+            chapter_tasks.append(run_task(executor, pack_document, *task_args))
+        
+        # Adicionar marcador final
+        sections.append(("END", page_count))
+        
+        # Dividir PDF por capítulos
+        for i, (title, start_page) in enumerate(sections[:-1]):
+            end_page = sections[i + 1][1]
+            prefix = f"{i+1:02d}"
+            task_args = (source_path, image_ladder, outline_index, start_page, end_page,
+                         output_dir, folder_name, prefix, pdf_filename)
+            chapter_tasks.append(run_task(executor, split_chapter, *task_args))
+        
+        if not executor:
+            close_documents([source_path] + [rung['path'] for rung in image_ladder or []])
+            image_ladders.pop(source_path, None)
+            print()
+        pdf_tasks.append((pdf_filename, chapter_tasks, None))
+        prepare_peaks[pdf_filename] = sample_memory()
+    
+    # Juntar os resultados na ordem dos PDFs e capítulos (independe da ordem de conclusão)
+    print("=== Resultado por PDF ===")
+    for pdf_filename, chapter_tasks, carried_rows in pdf_tasks:
+        if carried_rows is not None:
+            csv_data.extend(carried_rows)
+            print(f"[CACHE] {pdf_filename}: {len(carried_rows)} segmentos mantidos")
+            continue
+        
+        pdf_rows = []
+        all_files = []
+        peak_mb = prepare_peaks[pdf_filename]
+        failure = None
+        for task in chapter_tasks:
+            try:
+                csv_rows, files, task_peak_mb = task.result()
+            except MemoryError as e:
+                failure = e
+                continue
+            pdf_rows.extend(csv_rows)
+            all_files.extend(files)
+            peak_mb = max(peak_mb, task_peak_mb)
+        
+        # PDF incompleto: fica fora da tabela e do manifesto (será dividido de novo na próxima execução)
+        if failure:
+            print(f"[ERRO] {pdf_filename}: divisão interrompida ({failure})")
+            continue
+        csv_data.extend(pdf_rows)
+        
+        # Registrar a divisão no manifesto
+        manifest['files'][pdf_filename] = {
+            'sha256': source_hashes[pdf_filename],
+            'settings': SPLIT_SETTINGS,
+            'rows': pdf_rows,
+            'segments': {row['segment_path']: file_sha256(row['segment_path']) for row in pdf_rows}
+        }
+        
+        # Calcular tamanho total da pasta de saída
+        total_size = sum(os.path.getsize(f) for f in all_files)
+        print(f"[OK] {pdf_filename}: {len(all_files)} segmentos, {total_size / (1024*1024):.2f} MB, pico de memória {peak_mb:.0f} MB")
     
-    if not sections:
-        print(f"Sem capítulos válidos encontrados. Use o arquivo original.\n")
-        continue
+    if executor:
+        executor.shutdown()
     
-    # Adicionar marcador final
-    sections.append(("END", len(reader.pages)))
+    # Remover do manifesto PDFs que saíram da pasta de entrada
+    manifest['files'] = {name: entry for name, entry in manifest['files'].items() if name in source_hashes}
+    save_manifest(manifest)
     
-    # Abrir com pikepdf para dividir
-    pdf = pikepdf.open(pdf_path)
+    # Limitar o cache de cópias sem imagens e versões comprimidas
+    removed, cache_size = evict_cache(set(source_hashes.values()))
+    if removed:
+        print(f"[CACHE] {removed} arquivo(s) removido(s) do cache ({cache_size / (1024*1024):.2f} MB em uso)")
     
-    # Dividir PDF por capítulos
-    all_files = []
-    for i, (title, start_page) in enumerate(sections[:-1]):
-        end_page = sections[i + 1][1]
-        prefix = f"{i+1:02d}"
-        
-        files = split_section(pdf, reader, start_page, end_page, 
-                             output_dir, folder_name, prefix, 1, csv_data, pdf_filename)
-        all_files.extend(files)
+    # Salvar DataFrame como CSV
+    os.makedirs(DATA_FOLDER, exist_ok=True)
     
-    pdf.close()
+    df = pd.DataFrame(csv_data) if csv_data else pd.DataFrame(columns=SEGMENT_COLUMNS)
+    df.to_csv(csv_path, index=False)
     
-    # Calcular tamanho total da pasta de saída
-    total_size = sum(os.path.getsize(f) for f in all_files)
-    print(f"Tamanho total da saída: {total_size / (1024*1024):.2f} MB")
-    print(f"[OK] {pdf_filename} processado\n")
-
-# Salvar DataFrame como CSV
-os.makedirs(DATA_FOLDER, exist_ok=True)
-csv_path = os.path.join(DATA_FOLDER, TABLE_NAME)
-
-df = pd.DataFrame(csv_data)
-df.to_csv(csv_path, index=False)
+    print("\n=== Processamento concluído ===")
+    print(f"CSV salvo em: {csv_path}")
+    print(f"Total de segmentos: {len(df)}")
 
-print("=== Processamento concluído ===")
-print(f"CSV salvo em: {csv_path}")
-print(f"Total de segmentos: {len(df)}")
+if __name__ == "__main__":
+    main()
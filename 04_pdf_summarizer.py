@@ -1,9 +1,18 @@
 try:
     import os
+    import json
+    import time
+    import random
+    import re
+    import hashlib
+    import argparse
+    import threading
     import boto3
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
     import pandas as pd
     from pathlib import Path
-    from botocore.exceptions import ClientError
+    from botocore.exceptions import ClientError, BotoCoreError
     from botocore.config import Config
     from dotenv import load_dotenv
 except ModuleNotFoundError as e:
@@ -23,11 +32,39 @@ DATA_FOLDER = os.getenv('DATA_FOLDER')
 TABLE_NAME = os.getenv('PDF_SEGMENTS_TABLE')
 PROMPT_ARN = os.getenv('BEDROCK_PDF_SUMMARIZER_PROMPT_ARN')
 
-# Configuração com timeout para PDFs
+# Concorrência adaptativa (AIMD): cresce +1 a cada rodada de sucessos e cai pela metade com throttling
+MAX_WORKERS = int(os.getenv('BEDROCK_SUMMARY_MAX_WORKERS', 8))
+INITIAL_WORKERS = min(int(os.getenv('BEDROCK_SUMMARY_INITIAL_WORKERS', 2)), MAX_WORKERS)
+MAX_THROTTLE_RETRIES = int(os.getenv('BEDROCK_SUMMARY_MAX_THROTTLE_RETRIES', 8))
+THROTTLE_BASE_SECONDS = 2
+THROTTLE_MAX_SECONDS = 60
+
+# Diário (append-only) dos resumos concluídos: a tabela CSV é reescrita apenas a cada N registros e no final
+JOURNAL_FILE = os.getenv('PDF_SUMMARY_JOURNAL_FILE', 'output/pdf_summary_journal.jsonl')
+COMPACT_EVERY = int(os.getenv('PDF_SUMMARY_COMPACT_EVERY', 50))
+
+# Registros gravados no diário desde a última compactação
+journal_state = {'pending': 0}
+
+# Cache de respostas do Bedrock compartilhado com o 07_metadata_generator.py (conteúdo + ARN do prompt + texto da requisição)
+CACHE_FOLDER = os.getenv('BEDROCK_CACHE_FOLDER', 'output/bedrock_cache')
+CACHE_TTL_DAYS = float(os.getenv('BEDROCK_CACHE_TTL_DAYS', 30))
+CACHE_MAX_MB = float(os.getenv('BEDROCK_CACHE_MAX_MB', 256))
+CHARS_PER_TOKEN = 4
+
+# Texto enviado junto com o documento (faz parte da chave do cache)
+SUMMARY_REQUEST_TEXT = "Generate a structured markdown summary from the document."
+
+# Contadores do cache (atualizados apenas pela thread principal)
+cache_state = {'enabled': True, 'prompt_version': None}
+cache_stats = {'hits': 0, 'misses': 0, 'tokens_saved': 0}
+
+# Configuração com timeout para PDFs (um único cliente compartilhado pelas threads)
 bedrock_config = Config(
     read_timeout=300,  # 5 minutos
     connect_timeout=60,
-    retries={'max_attempts': 3, 'mode': 'adaptive'}
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    max_pool_connections=MAX_WORKERS
 )
 
 # Inicializar cliente AWS
@@ -48,18 +85,62 @@ def load_segments_table():
     if 'summary_path' not in df.columns:
         df['summary_path'] = ''
         print("Coluna 'summary_path' adicionada à tabela")
+    df['summary_path'] = df['summary_path'].fillna('')
     
     return df
 
 def save_segments_table(df):
-    """Salva DataFrame como CSV"""
+    """Salva DataFrame como CSV (escrita atômica)"""
     csv_path = os.path.join(DATA_FOLDER, TABLE_NAME)
-    df.to_csv(csv_path, index=False)
+    tmp_path = f"{csv_path}.tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, csv_path)
 
-def update_summary_path(df, segment_name, summary_path):
-    """Atualiza summary_path no DataFrame e salva"""
-    df.loc[df['segment_name'] == segment_name, 'summary_path'] = summary_path
+def append_journal(segment_name, summary_path):
+    """Registra um resumo concluído no diário e força a gravação em disco (fsync)"""
+    os.makedirs(os.path.dirname(JOURNAL_FILE) or '.', exist_ok=True)
+    entry = json.dumps({'segment_name': segment_name, 'summary_path': summary_path}, ensure_ascii=False)
+    with open(JOURNAL_FILE, 'a', encoding='utf-8') as f:
+        f.write(entry + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def replay_journal(df):
+    """Aplica ao DataFrame os resumos registrados no diário desde a última compactação"""
+    if not os.path.exists(JOURNAL_FILE):
+        return 0
+    
+    entries = {}
+    with open(JOURNAL_FILE, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Última linha incompleta (execução interrompida durante a escrita)
+                print(f"[AVISO] Linha inválida ignorada no diário: {JOURNAL_FILE}")
+                continue
+            entries[entry['segment_name']] = entry['summary_path']
+    
+    if entries:
+        replayed = df['segment_name'].map(entries)
+        df['summary_path'] = replayed.fillna(df['summary_path'])
+    return len(entries)
+
+def compact_table(df):
+    """Reescreve a tabela CSV com o estado atual e descarta o diário já aplicado"""
     save_segments_table(df)
+    if os.path.exists(JOURNAL_FILE):
+        os.remove(JOURNAL_FILE)
+    journal_state['pending'] = 0
+
+def update_summary_path(df, row_index, segment_name, summary_path):
+    """Atualiza summary_path no DataFrame e registra no diário (a tabela é compactada periodicamente)"""
+    df.at[row_index, 'summary_path'] = summary_path
+    append_journal(segment_name, summary_path)
+    
+    journal_state['pending'] += 1
+    if journal_state['pending'] >= COMPACT_EVERY:
+        compact_table(df)
 
 def sanitize_document_name(file_path):
     """Sanitiza o nome do documento para atender requisitos do Bedrock"""
@@ -75,10 +156,10 @@ def sanitize_document_name(file_path):
     return document_name
 
 def generate_summary_with_bedrock(file_path):
-    """Gera resumo usando AWS Bedrock"""
+    """Gera resumo usando AWS Bedrock
     
-    print(f"Gerando resumo...")
-    print(f"Arquivo: {file_path}")
+    Throttling (ThrottlingException) é repassado a quem chamou, que ajusta a concorrência e tenta de novo
+    """
     
     # Ler documento local
     with open(file_path, "rb") as f:
@@ -87,7 +168,7 @@ def generate_summary_with_bedrock(file_path):
     file_extension = os.path.splitext(file_path)[1][1:].lower()
     document_name = sanitize_document_name(file_path)
     
-    print(f"Documento: {len(doc_bytes)} bytes ({len(doc_bytes) / 1024 / 1024:.2f} MB)")
+    print(f"  Enviando {file_path} ({len(doc_bytes) / 1024 / 1024:.2f} MB) para o Bedrock...")
     
     # Mensagem com documento local
     messages = [
@@ -101,14 +182,12 @@ def generate_summary_with_bedrock(file_path):
                         "source": {"bytes": doc_bytes}
                     }
                 },
-                {"text": "Generate a structured markdown summary from the document."}
+                {"text": SUMMARY_REQUEST_TEXT}
             ]
         }
     ]
     
     try:
-        print(f"Enviando requisição para Bedrock...")
-        
         response = bedrock_runtime_client.converse(
             modelId=PROMPT_ARN,
             messages=messages
@@ -117,14 +196,18 @@ def generate_summary_with_bedrock(file_path):
         # Extrair resultado
         summary = response["output"]["message"]["content"][0]["text"]
         
-        print(f"  Resumo gerado com sucesso ({len(summary)} caracteres)")
+        print(f"  Resumo gerado com sucesso para {document_name} ({len(summary)} caracteres)")
+        store_cached_response(cache_key(content_hash(doc_bytes), SUMMARY_REQUEST_TEXT), summary, response.get("usage"))
         return summary
         
     except ClientError as e:
         error_code = e.response['Error']['Code']
         error_message = e.response['Error']['Message']
         
-        print(f"  Erro: {error_code}")
+        if error_code == "ThrottlingException":
+            raise
+        
+        print(f"  Erro em {document_name}: {error_code}")
         print(f"  Mensagem: {error_message}\n")
         print("  Sugestões:")
         
@@ -135,14 +218,123 @@ def generate_summary_with_bedrock(file_path):
         elif error_code == "ValidationException":
             print("  - O nome do arquivo contém caracteres inválidos")
             print("  - Renomeie o arquivo usando apenas: letras, números, espaços, hífens, parênteses e colchetes")
-        elif error_code == "ThrottlingException":
-            print("  - Muitas requisições simultâneas. Aguarde alguns segundos e tente novamente")
         
         return None
         
     except Exception as e:
-        print(f"  Erro inesperado: {e}")
+        print(f"  Erro inesperado em {document_name}: {e}")
+        return None
+
+def content_hash(data):
+    """SHA-256 do conteúdo enviado ao Bedrock (bytes do documento ou texto)"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def resolve_prompt_version():
+    """Versão do prompt usada na chave do cache (None se não for possível identificá-la)
+    
+    ARNs com versão (...:prompt/ID:N) são imutáveis; sem versão, o ARN aponta para o rascunho,
+    identificado pela data da última alteração (bedrock-agent get_prompt)
+    """
+    match = re.search(r':prompt/[^:/]+:(\d+)$', PROMPT_ARN or '')
+    if match:
+        return match.group(1)
+    
+    try:
+        prompt = boto3.client("bedrock-agent").get_prompt(promptIdentifier=PROMPT_ARN)
+    except (ClientError, BotoCoreError) as e:
+        print(f"[AVISO] Versão do prompt não identificada ({e}); cache de respostas desativado")
+        return None
+    return f"{prompt['version']}@{prompt['updatedAt'].isoformat()}"
+
+def cache_key(content_sha256, request_text):
+    """Chave do cache: hash do conteúdo, ARN e versão do prompt e texto da requisição"""
+    key_data = json.dumps([content_sha256, PROMPT_ARN, cache_state['prompt_version'], request_text], ensure_ascii=False)
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+def cache_path_for(key):
+    """Caminho da resposta em cache"""
+    return os.path.join(CACHE_FOLDER, f"{key}.json")
+
+def is_expired(path):
+    """Verifica se a entrada do cache passou do BEDROCK_CACHE_TTL_DAYS (0 = sem expiração)"""
+    return CACHE_TTL_DAYS > 0 and time.time() - os.path.getmtime(path) > CACHE_TTL_DAYS * 86400
+
+def load_cached_response(key):
+    """Retorna a resposta em cache (ou None) e atualiza as estatísticas"""
+    path = cache_path_for(key)
+    if not cache_state['enabled'] or not cache_state['prompt_version'] or not os.path.exists(path) or is_expired(path):
+        cache_stats['misses'] += 1
+        return None
+    
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"[AVISO] Entrada inválida no cache, ignorando: {path}")
+        cache_stats['misses'] += 1
         return None
+    
+    # Último uso no atime (LRU); o mtime guarda a criação (TTL)
+    os.utime(path, (time.time(), os.path.getmtime(path)))
+    cache_stats['hits'] += 1
+    cache_stats['tokens_saved'] += entry.get('tokens', 0)
+    return entry['response']
+
+def store_cached_response(key, response, usage=None):
+    """Grava a resposta no cache (escrita atômica; seguro entre threads e processos)"""
+    if not cache_state['prompt_version']:
+        return
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    tokens = (usage or {}).get('totalTokens') or len(json.dumps(response, ensure_ascii=False)) // CHARS_PER_TOKEN
+    path = cache_path_for(key)
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'prompt_arn': PROMPT_ARN, 'prompt_version': cache_state['prompt_version'], 'tokens': tokens, 'response': response}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def evict_cache():
+    """Remove entradas expiradas e, depois, as usadas há mais tempo até o cache caber em BEDROCK_CACHE_MAX_MB"""
+    if not os.path.isdir(CACHE_FOLDER):
+        return 0, 0
+    
+    entries = []
+    removed = 0
+    for name in os.listdir(CACHE_FOLDER):
+        path = os.path.join(CACHE_FOLDER, name)
+        if is_expired(path):
+            os.remove(path)
+            removed += 1
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_atime, stat.st_size, path))
+    
+    total_size = sum(size for _, size, _ in entries)
+    max_size = CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(path)
+        total_size -= size
+        removed += 1
+    return removed, total_size
+
+def report_cache():
+    """Exibe taxa de acerto do cache e tokens economizados (estimativa)"""
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    hit_rate = cache_stats['hits'] / lookups * 100 if lookups else 0
+    removed, cache_size = evict_cache()
+    print(f"Cache: {cache_stats['hits']}/{lookups} acertos ({hit_rate:.0f}%), ~{cache_stats['tokens_saved']} tokens economizados")
+    print(f"Tamanho do cache: {cache_size / (1024*1024):.2f} MB ({removed} entradas antigas removidas)")
+
+def throttle_delay(attempt):
+    """Espera antes de repetir um segmento limitado por throttling (backoff exponencial com jitter)"""
+    return random.uniform(0, min(THROTTLE_MAX_SECONDS, THROTTLE_BASE_SECONDS * 2 ** attempt))
+
+def is_throttling(error):
+    """Verifica se a exceção é um ThrottlingException do Bedrock"""
+    return isinstance(error, ClientError) and error.response['Error']['Code'] == "ThrottlingException"
 
 def save_summary(summary, segment_path, segment_name):
     """Salva o resumo como arquivo markdown na mesma pasta do segmento"""
@@ -161,6 +353,13 @@ def save_summary(summary, segment_path, segment_name):
     print(f"  Resumo salvo em: {markdown_path}")
     return os.path.relpath(markdown_path, '.')
 
+parser = argparse.ArgumentParser(description="Gera resumos dos segmentos de PDF com AWS Bedrock")
+parser.add_argument('--no-cache', action='store_true',
+                    help="Ignora respostas em cache e chama o Bedrock novamente (as novas respostas substituem o cache)")
+args = parser.parse_args()
+cache_state['enabled'] = not args.no_cache
+cache_state['prompt_version'] = resolve_prompt_version()
+
 # Carregar tabela
 df = load_segments_table()
 print(f"Segmentos para processar: {len(df)}\n")
@@ -169,37 +368,118 @@ if df.empty:
     print("Nenhum segmento encontrado.")
     exit(1)
 
-# Processar cada segmento
-success_count = 0
+# Recuperar resumos registrados no diário por uma execução interrompida
+replayed = replay_journal(df)
+if replayed:
+    print(f"[OK] {replayed} resumo(s) recuperado(s) do diário: {JOURNAL_FILE}")
+    compact_table(df)
 
+# Selecionar segmentos pendentes (resumos já gerados são pulados, o que permite retomar a execução)
+success_count = 0
+pending = deque()
 for i, row in df.iterrows():
-    print(f"\n[{i+1}/{len(df)}] Processando: {row['segment_name']}")
-    
     # Verificar se já foi processado
-    if pd.notna(row['summary_path']) and row['summary_path']:
-        print(f"  Resumo já existe, pulando...")
+    if row['summary_path']:
+        print(f"[{i+1}/{len(df)}] {row['segment_name']}: resumo já existe, pulando...")
         continue
     
     # Verificar se arquivo existe
     if not os.path.exists(row['segment_path']):
-        print(f"  Arquivo não encontrado: {row['segment_path']}")
+        print(f"[{i+1}/{len(df)}] {row['segment_name']}: arquivo não encontrado: {row['segment_path']}")
         continue
     
-    # Gerar resumo
-    summary = generate_summary_with_bedrock(row['segment_path'])
-    
+    # Reaproveitar resumo em cache (mesmo documento, prompt e requisição), sem ocupar a concorrência
+    with open(row['segment_path'], 'rb') as f:
+        key = cache_key(content_hash(f.read()), SUMMARY_REQUEST_TEXT)
+    summary = load_cached_response(key)
     if summary:
-        # Salvar resumo
+        print(f"[{i+1}/{len(df)}] {row['segment_name']}: resumo encontrado no cache")
         summary_path = save_summary(summary, row['segment_path'], row['segment_name'])
+        update_summary_path(df, row.name, row['segment_name'], summary_path)
+        success_count += 1
+        continue
+    
+    pending.append(row)
+
+print(f"\nSegmentos pendentes: {len(pending)} (concorrência inicial {INITIAL_WORKERS}, máxima {MAX_WORKERS})\n")
+
+# Processar os segmentos em paralelo com concorrência adaptativa
+concurrency = float(INITIAL_WORKERS)
+throttle_attempts = {}
+retry_after = {}
+in_flight = {}
+# Sequência de envio: só requisições enviadas após a última redução podem reduzir de novo (uma vez por janela)
+submitted = 0
+last_decrease = -1
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+while pending or in_flight:
+    # Enviar segmentos até o limite atual de concorrência (respeitando a espera após throttling)
+    now = time.time()
+    for _ in range(len(pending)):
+        if len(in_flight) >= int(concurrency):
+            break
+        row = pending.popleft()
+        if retry_after.get(row['segment_name'], 0) > now:
+            pending.append(row)
+            continue
+        retry_after.pop(row['segment_name'], None)
+        print(f"[{row.name + 1}/{len(df)}] Processando: {row['segment_name']} ({len(in_flight) + 1}/{int(concurrency)} simultâneos)")
+        in_flight[executor.submit(generate_summary_with_bedrock, row['segment_path'])] = (row, submitted)
+        submitted += 1
+    
+    if not in_flight:
+        # Todos os pendentes aguardam o backoff: dormir até o primeiro liberar
+        next_retry = min(retry_after.get(row['segment_name'], 0) for row in pending)
+        time.sleep(max(0.1, next_retry - time.time()))
+        continue
+    
+    done, _ = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+    for future in done:
+        row, sequence = in_flight.pop(future)
+        segment_name = row['segment_name']
         
-        # Atualizar tabela imediatamente
-        update_summary_path(df, row['segment_name'], summary_path)
-        print(f"  Tabela atualizada com path: {summary_path}")
+        try:
+            summary = future.result()
+        except ClientError as e:
+            if not is_throttling(e):
+                raise
+            
+            # Diminuição multiplicativa: metade da concorrência, uma vez por janela (throttles de
+            # requisições enviadas antes da última redução já foram considerados nela)
+            if sequence > last_decrease:
+                concurrency = max(1.0, concurrency / 2)
+                last_decrease = submitted - 1
+            attempt = throttle_attempts.get(segment_name, 0)
+            if attempt >= MAX_THROTTLE_RETRIES:
+                print(f"  Falha ao gerar resumo para {segment_name}: throttling persistente")
+                continue
+            throttle_attempts[segment_name] = attempt + 1
+            delay = throttle_delay(attempt)
+            retry_after[segment_name] = time.time() + delay
+            pending.append(row)
+            print(f"  Throttling em {segment_name}: concorrência {int(concurrency)}, nova tentativa em {delay:.1f}s")
+            continue
         
-        success_count += 1
-    else:
-        print(f"  Falha ao gerar resumo para {row['segment_name']}")
+        if summary:
+            # Aumento aditivo: +1 na concorrência a cada rodada completa de sucessos
+            concurrency = min(float(MAX_WORKERS), concurrency + 1 / concurrency)
+            
+            # Salvar resumo e registrar no diário imediatamente (apenas nesta thread)
+            summary_path = save_summary(summary, row['segment_path'], segment_name)
+            update_summary_path(df, row.name, segment_name, summary_path)
+            print(f"  Diário atualizado com path: {summary_path}")
+            
+            success_count += 1
+        else:
+            print(f"  Falha ao gerar resumo para {segment_name}")
+
+executor.shutdown()
+
+# Compactar a tabela com os registros restantes do diário
+compact_table(df)
 
 print(f"\n=== Processamento Concluído ===")
 print(f"Resumos gerados: {success_count}/{len(df)}")
 print(f"Tabela: {os.path.join(DATA_FOLDER, TABLE_NAME)}")
+report_cache()
@@ -1,10 +1,14 @@
 try:
     import os
     import json
+    import time
+    import re
+    import hashlib
+    import argparse
     import boto3
     import pandas as pd
     from datetime import datetime, timedelta
-    from botocore.exceptions import ClientError
+    from botocore.exceptions import ClientError, BotoCoreError
     from botocore.config import Config
     from dotenv import load_dotenv
 except ModuleNotFoundError as e:
@@ -33,6 +37,16 @@ PUBLISH_TIME = os.getenv('METADATA_PUBLISH_TIME')
 
 METADATA_MAX_RETRIES = int(os.getenv('METADATA_MAX_RETRIES', 3))
 
+# Cache de respostas do Bedrock compartilhado com o 04_pdf_summarizer.py (conteúdo + ARN do prompt + texto da requisição)
+CACHE_FOLDER = os.getenv('BEDROCK_CACHE_FOLDER', 'output/bedrock_cache')
+CACHE_TTL_DAYS = float(os.getenv('BEDROCK_CACHE_TTL_DAYS', 30))
+CACHE_MAX_MB = float(os.getenv('BEDROCK_CACHE_MAX_MB', 256))
+CHARS_PER_TOKEN = 4
+
+# Contadores do cache
+cache_state = {'enabled': True, 'prompt_version': None}
+cache_stats = {'hits': 0, 'misses': 0, 'tokens_saved': 0}
+
 # Metadados genéricos de fallback
 FALLBACK_METADATA = {
     "localizations": {
@@ -145,6 +159,109 @@ def sanitize_document_name(file_path):
 
 
 
+def content_hash(data):
+    """SHA-256 do conteúdo enviado ao Bedrock (bytes do documento ou texto)"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def resolve_prompt_version():
+    """Versão do prompt usada na chave do cache (None se não for possível identificá-la)
+    
+    ARNs com versão (...:prompt/ID:N) são imutáveis; sem versão, o ARN aponta para o rascunho,
+    identificado pela data da última alteração (bedrock-agent get_prompt)
+    """
+    match = re.search(r':prompt/[^:/]+:(\d+)$', PROMPT_ARN or '')
+    if match:
+        return match.group(1)
+    
+    try:
+        prompt = boto3.client("bedrock-agent").get_prompt(promptIdentifier=PROMPT_ARN)
+    except (ClientError, BotoCoreError) as e:
+        print(f"[AVISO] Versão do prompt não identificada ({e}); cache de respostas desativado")
+        return None
+    return f"{prompt['version']}@{prompt['updatedAt'].isoformat()}"
+
+def cache_key(content_sha256, request_text):
+    """Chave do cache: hash do conteúdo, ARN e versão do prompt e texto da requisição"""
+    key_data = json.dumps([content_sha256, PROMPT_ARN, cache_state['prompt_version'], request_text], ensure_ascii=False)
+    return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+def cache_path_for(key):
+    """Caminho da resposta em cache"""
+    return os.path.join(CACHE_FOLDER, f"{key}.json")
+
+def is_expired(path):
+    """Verifica se a entrada do cache passou do BEDROCK_CACHE_TTL_DAYS (0 = sem expiração)"""
+    return CACHE_TTL_DAYS > 0 and time.time() - os.path.getmtime(path) > CACHE_TTL_DAYS * 86400
+
+def load_cached_response(key):
+    """Retorna a resposta em cache (ou None) e atualiza as estatísticas"""
+    path = cache_path_for(key)
+    if not cache_state['enabled'] or not cache_state['prompt_version'] or not os.path.exists(path) or is_expired(path):
+        cache_stats['misses'] += 1
+        return None
+    
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print(f"  [AVISO] Entrada inválida no cache, ignorando: {path}")
+        cache_stats['misses'] += 1
+        return None
+    
+    # Último uso no atime (LRU); o mtime guarda a criação (TTL)
+    os.utime(path, (time.time(), os.path.getmtime(path)))
+    cache_stats['hits'] += 1
+    cache_stats['tokens_saved'] += entry.get('tokens', 0)
+    return entry['response']
+
+def store_cached_response(key, response, usage=None):
+    """Grava a resposta no cache (escrita atômica)"""
+    if not cache_state['prompt_version']:
+        return
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    tokens = (usage or {}).get('totalTokens') or len(json.dumps(response, ensure_ascii=False)) // CHARS_PER_TOKEN
+    path = cache_path_for(key)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'prompt_arn': PROMPT_ARN, 'prompt_version': cache_state['prompt_version'], 'tokens': tokens, 'response': response}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def evict_cache():
+    """Remove entradas expiradas e, depois, as usadas há mais tempo até o cache caber em BEDROCK_CACHE_MAX_MB"""
+    if not os.path.isdir(CACHE_FOLDER):
+        return 0, 0
+    
+    entries = []
+    removed = 0
+    for name in os.listdir(CACHE_FOLDER):
+        path = os.path.join(CACHE_FOLDER, name)
+        if is_expired(path):
+            os.remove(path)
+            removed += 1
+            continue
+        stat = os.stat(path)
+        entries.append((stat.st_atime, stat.st_size, path))
+    
+    total_size = sum(size for _, size, _ in entries)
+    max_size = CACHE_MAX_MB * 1024 * 1024
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(path)
+        total_size -= size
+        removed += 1
+    return removed, total_size
+
+def report_cache():
+    """Exibe taxa de acerto do cache e tokens economizados (estimativa)"""
+    lookups = cache_stats['hits'] + cache_stats['misses']
+    hit_rate = cache_stats['hits'] / lookups * 100 if lookups else 0
+    removed, cache_size = evict_cache()
+    print(f"Cache: {cache_stats['hits']}/{lookups} acertos ({hit_rate:.0f}%), ~{cache_stats['tokens_saved']} tokens economizados")
+    print(f"Tamanho do cache: {cache_size / (1024*1024):.2f} MB ({removed} entradas antigas removidas)")
+
 def truncate_description(description, max_length=5000):
     """Trunca descrição se exceder o limite, cortando no último '. ' (ponto + espaço)"""
     if len(description) <= max_length:
@@ -241,12 +358,14 @@ def generate_metadata_with_bedrock(file_path, call_number, transcription_content
         print(f"Transcrição incluída: {len(transcription_content)} caracteres")
         
         transcription_text = f"the following transcription context:\n\nThe following context is the transcription of the audio content. Please note that there may be errors due to transcription inaccuracies:\n\n<AUDIO-TRANSCRIPTION>\n{transcription_content}\n</AUDIO-TRANSCRIPTION>"
+        request_text = f"Generate YouTube metadata from {transcription_text}."
+        key = cache_key(content_hash(transcription_content), request_text)
         
         messages = [
             {
                 "role": "user",
                 "content": [
-                    {"text": f"Generate YouTube metadata from {transcription_text}."}
+                    {"text": request_text}
                 ]
             }
         ]
@@ -259,6 +378,8 @@ def generate_metadata_with_bedrock(file_path, call_number, transcription_content
         document_name = sanitize_document_name(file_path)
         
         print(f"Documento: {len(doc_bytes)} bytes ({len(doc_bytes) / 1024 / 1024:.2f} MB)")
+        request_text = "Generate YouTube metadata from the attached document."
+        key = cache_key(content_hash(doc_bytes), request_text)
         
         messages = [
             {
@@ -271,11 +392,17 @@ def generate_metadata_with_bedrock(file_path, call_number, transcription_content
                             "source": {"bytes": doc_bytes}
                         }
                     },
-                    {"text": "Generate YouTube metadata from the attached document."}
+                    {"text": request_text}
                 ]
             }
         ]
     
+    # Reaproveitar metadados em cache (mesmo conteúdo, prompt e requisição)
+    cached = load_cached_response(key)
+    if cached:
+        print(f"  Metadados encontrados no cache")
+        return cached
+    
     # Tentar até METADATA_MAX_RETRIES vezes
     for attempt in range(1, METADATA_MAX_RETRIES + 1):
         if attempt > 1:
@@ -297,6 +424,7 @@ def generate_metadata_with_bedrock(file_path, call_number, transcription_content
             
             if is_valid:
                 print(f"  Metadados gerados com sucesso")
+                store_cached_response(key, result, response.get("usage"))
                 return result
             else:
                 print(f"  [AVISO] Metadados incompletos: {validation_message}")
@@ -348,6 +476,13 @@ def generate_metadata_with_bedrock(file_path, call_number, transcription_content
     
     return FALLBACK_METADATA.copy()
 
+parser = argparse.ArgumentParser(description="Gera metadados multilíngues dos vídeos com AWS Bedrock")
+parser.add_argument('--no-cache', action='store_true',
+                    help="Ignora respostas em cache e chama o Bedrock novamente (as novas respostas substituem o cache)")
+args = parser.parse_args()
+cache_state['enabled'] = not args.no_cache
+cache_state['prompt_version'] = resolve_prompt_version()
+
 # Carregar vídeos
 df, original_count = load_video_data()
 
@@ -424,3 +559,4 @@ print(f"\n=== Processamento Concluído ===")
 print(f"Vídeos processados: {success_count}/{len(df)}")
 print(f"Metadados salvos em: {OUTPUT_FILE}")
 print(f"Total de vídeos no arquivo: {len(existing_metadata)}")
+report_cache()